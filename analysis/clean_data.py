@@ -6,16 +6,339 @@ Author: Charmaine Runes
 This file loads CSV files into pandas dataframes and cleans the data.
 '''
 
+import ast
+import functools
+import hashlib
+import json
+import os
+import re
 import pandas as pd
 import numpy as np
 import csv
 
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
 
-def load_data(filename):
+# Schema of each table, found from the name of its CSV file: columns to read
+# as categoricals, as datetimes and as lists written out by scrape_wiki
+SCHEMAS = {
+    'seasons': {'category': ['name'],
+                'dates': ['start_date', 'end_date'],
+                'lists': []},
+    'episodes': {'category': ['season'],
+                 'dates': ['airdate'],
+                 'lists': []},
+    'transcripts': {'category': ['episode', 'speaker', 'location'],
+                    'dates': [],
+                    'lists': ['actions']},
+}
+
+# Bump when SCHEMAS or the parsing changes, so older caches are rebuilt
+CACHE_VERSION = 1
+CACHE_EXTENSION = '.feather'
+META_EXTENSION = '.meta.json'
+
+# Separators between speakers e.g., "Amethyst, Ruby & Sapphire"
+SPEAKER_SPLIT_PATTERN = re.compile(', |& |and ')
+
+
+def load_data(filename, typed=True, use_cache=True):
+    '''
+    Takes a filename and returns a pandas dataframe. If the file is one of
+        the tables scrape_wiki writes (seasons, episodes or transcripts), its
+        schema is applied: names and titles become categoricals, dates are
+        parsed and actions become tuples of strings.
+
+        A typed table is also cached as a Feather file next to the CSV (e.g.,
+        transcripts.feather), when pyarrow is installed. The cache is used as
+        long as the CSV is unchanged: same size and modification time, or
+        failing that, the same contents.
+
+    Inputs:
+        - filename (str): path to a CSV file
+        - typed (bool): whether to apply the table's schema
+        - use_cache (bool): whether to read and write the Feather cache
+
+    Returns a pandas DataFrame
+    '''
+    schema = get_schema(filename) if typed else None
+
+    if schema is None:
+        return pd.read_csv(filename)
+
+    if not use_cache or feather is None:
+        return read_typed_csv(filename, schema)
+
+    meta = read_cache_meta(filename)
+    if meta is not None:
+        return feather.read_table(filename_for_cache(filename)) \
+                      .to_pandas(split_blocks=True) \
+                      .pipe(restore_lists, schema)
+
+    df = read_typed_csv(filename, schema)
+    write_cache(filename, df)
+
+    return df
+
+
+def get_schema(filename):
+    '''
+    Returns the schema of a table from the name of its file (e.g.,
+        'data/transcripts.csv' -> SCHEMAS['transcripts']), or None
+    '''
+    table = os.path.splitext(os.path.basename(filename))[0]
+
+    return SCHEMAS.get(table)
+
+
+def read_typed_csv(filename, schema):
+    '''
+    Reads a CSV file and applies a schema to it (see SCHEMAS)
+
+    Inputs:
+        - filename (str): path to a CSV file
+        - schema (dict): columns to read as categoricals, dates and lists
+
+    Returns a pandas DataFrame
+    '''
+    dtypes = {col: 'category' for col in schema['category']}
+    dtypes.update({col: str for col in schema['lists']})
+
+    df = pd.read_csv(filename, dtype=dtypes, parse_dates=schema['dates'])
+
+    for col in schema['lists']:
+        df[col] = parse_lists(df[col])
+
+    return df
+
+
+def parse_lists(series):
     '''
-    Takes a filename and returns a pandas dataframe
+    Takes a pandas Series of lists written as strings (e.g., "['grabs Lars']")
+        and returns a Series of tuples. Each distinct string is only parsed
+        once, and rows with the same string share one tuple; most lines have
+        no actions at all ("[]").
+
+    Inputs:
+        - series (pandas Series): Series of strings
+
+    Returns a pandas Series of tuples, with missing values as empty tuples
     '''
+    codes, uniques = pd.factorize(series, sort=False)
+    parsed = [tuple(ast.literal_eval(value)) for value in uniques]
+    parsed.append(())   # code -1, a missing value
+
+    return pd.Series([parsed[code] for code in codes], index=series.index,
+                     name=series.name, dtype=object)
+
 
-    df = pd.read_csv(filename)
+def restore_lists(df, schema):
+    '''
+    Turns the list columns of a table read from the cache, which pyarrow
+        returns as numpy arrays, back into tuples of strings
+    '''
+    for col in schema['lists']:
+        df[col] = pd.Series([tuple(values) for values in df[col]],
+                            index=df.index, name=col, dtype=object)
 
     return df
+
+
+def filename_for_cache(filename, extension=CACHE_EXTENSION):
+    '''
+    Returns the path of a CSV file's cache e.g., 'data/transcripts.feather'
+    '''
+    return os.path.splitext(filename)[0] + extension
+
+
+def hash_file(filename, chunk_size=1 << 20):
+    '''
+    Returns the SHA-256 hex digest of a file's contents
+    '''
+    digest = hashlib.sha256()
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_cache_meta(filename):
+    '''
+    Checks whether the cache of a CSV file is still valid. A change in the
+        CSV's size or modification time alone does not invalidate it, as
+        long as the contents hash the same (the meta file is then updated).
+
+    Inputs:
+        - filename (str): path to a CSV file
+
+    Returns the dictionary in the meta file, or None if the cache is missing
+        or out of date
+    '''
+    meta_file = filename_for_cache(filename, META_EXTENSION)
+
+    if not os.path.exists(filename_for_cache(filename)):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    stat = os.stat(filename)
+    if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return meta
+
+    if meta['size'] != stat.st_size or meta['sha256'] != hash_file(filename):
+        return None
+
+    meta['mtime_ns'] = stat.st_mtime_ns
+    write_json(meta_file, meta)
+
+    return meta
+
+
+def write_cache(filename, df):
+    '''
+    Writes a typed table to the Feather cache of its CSV file, along with a
+        meta file describing the CSV it came from. Both are written to a
+        temporary file first, so a failed write never leaves a partial cache.
+
+    Inputs:
+        - filename (str): path to the CSV file the table was read from
+        - df (pandas DataFrame): the typed table
+    '''
+    stat = os.stat(filename)
+    meta = {'version': CACHE_VERSION,
+            'source': os.path.basename(filename),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': hash_file(filename)}
+
+    cache_file = filename_for_cache(filename)
+    try:
+        feather.write_feather(df, cache_file + '.tmp')
+        os.replace(cache_file + '.tmp', cache_file)
+        write_json(filename_for_cache(filename, META_EXTENSION), meta)
+    except OSError:
+        # A read-only data folder just means no cache
+        return None
+
+    return meta
+
+
+def write_json(filename, obj):
+    '''
+    Writes an object to a JSON file, replacing it in one step
+    '''
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(obj, f)
+
+    os.replace(filename + '.tmp', filename)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_speaker(speaker_str):
+    '''
+    Takes a string representing one or more possible speakers and returns a
+        tuple of the speakers, in the order they are written. The result is
+        cached, so each distinct string is only split once.
+
+        Examples:
+        parse_speaker('Amethyst, Ruby & Sapphire') ->
+            ('Amethyst', 'Ruby', 'Sapphire')
+
+        parse_speaker('Mr. Smiley and Jamie') ->
+            ('Mr. Smiley', 'Jamie')
+
+    Input:
+        - speaker_str (str): String representing one or more speakers
+
+    Returns a tuple of clean speakers, without duplicates or blanks
+    '''
+    speakers = []
+
+    for speaker in SPEAKER_SPLIT_PATTERN.split(speaker_str):
+        speaker = speaker.strip()
+        if speaker != '' and speaker not in speakers:
+            speakers.append(speaker)
+
+    return tuple(speakers)
+
+
+def normalize_speakers(transcripts, column='speaker'):
+    '''
+    Takes a pandas DataFrame of transcript lines and maps every line to the
+        canonical speakers in its speaker string. Each distinct string is
+        parsed once (see parse_speaker); the lines are then mapped with
+        factorize and a merge rather than row by row.
+
+    Inputs:
+        - transcripts (pandas DataFrame): each row a line in a transcript; its
+            index is used as the line_id
+        - column (str): name of the column with the speaker strings
+
+    Returns a tuple of two DataFrames:
+        - speakers, with a speaker_id and name for every canonical speaker, in
+            order of first appearance
+        - line_speakers, with one (line_id, speaker_id) row per speaker of each
+            line, in line order; lines without a speaker are left out
+    '''
+    raw_codes, raw_speakers = pd.factorize(transcripts[column], sort=False)
+
+    # Parse each distinct speaker string, and number the names it contains
+    speaker_ids = {}
+    raw_to_ids = []
+
+    for raw_code, speaker_str in enumerate(raw_speakers):
+        for name in parse_speaker(speaker_str):
+            speaker_id = speaker_ids.setdefault(name, len(speaker_ids))
+            raw_to_ids.append((raw_code, speaker_id))
+
+    speakers = pd.DataFrame({'speaker_id': np.arange(len(speaker_ids)),
+                             'name': list(speaker_ids)})
+    raw_map = pd.DataFrame(raw_to_ids, columns=['raw_code', 'speaker_id'])
+
+    has_speaker = raw_codes >= 0
+    lines = pd.DataFrame({'line_id': transcripts.index[has_speaker],
+                          'raw_code': raw_codes[has_speaker]})
+
+    line_speakers = lines.merge(raw_map, on='raw_code', how='inner', sort=False)
+    line_speakers = line_speakers[['line_id', 'speaker_id']]
+
+    return speakers, line_speakers
+
+
+def count_lines_by_speaker(transcripts, by='episode', split_speakers=False):
+    '''
+    Counts the lines of every speaker in every episode (or other grouping)
+        in a single pass over the transcripts
+
+    Inputs:
+        - transcripts (pandas DataFrame): each row a line in a transcript
+        - by (str): name of the column to count within e.g., 'episode'
+        - split_speakers (bool): whether a line spoken by several speakers
+            (e.g., "Ruby & Sapphire") counts for each of them (see
+            normalize_speakers), rather than for the string as written
+
+    Returns a pandas Series of line counts indexed by (by, speaker)
+    '''
+    if not split_speakers:
+        return transcripts.groupby([by, 'speaker'], sort=False,
+                                   observed=True).size()
+
+    speakers, line_speakers = normalize_speakers(transcripts)
+    names = speakers['name'].to_numpy()
+
+    lines = pd.DataFrame({
+        by: transcripts.loc[line_speakers['line_id'], by].to_numpy(),
+        'speaker': names[line_speakers['speaker_id'].to_numpy()]})
+
+    return lines.groupby([by, 'speaker'], sort=False, observed=True).size()
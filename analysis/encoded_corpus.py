@@ -0,0 +1,226 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file stores tokenized lines as integer token IDs in contiguous arrays,
+so the same lines can be grouped into documents by episode, season or
+speaker without keeping a separate list of strings for every grouping.
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import tokenizer
+
+
+class EncodedCorpus():
+    '''
+    Class for an integer-encoded corpus. Every line's tokens are stored as
+    IDs into a shared vocabulary, one line after another in a single array;
+    offsets[i]:offsets[i + 1] are the tokens of line i. Each line also has a
+    code in every grouping column (e.g., its episode), which is how lines
+    are gathered into documents. See Constructor for attributes.
+
+    Example:
+        corpus = EncodedCorpus.from_dataframe(transcripts, 'quote',
+                                              ['episode', 'speaker'])
+        corpus.document('episode', 'Gem Glow') -> array of token IDs
+        corpus.to_dict('speaker') -> {'Steven': ['noooo', ...], ...}
+    '''
+
+    def __init__(self, vocabulary, token_ids, offsets, columns, has_text=None):
+        '''
+        Creates an instance of an EncodedCorpus.
+
+        Attributes:
+            - vocabulary (list): Term for each token ID
+            - term_ids (dict): Token ID for each term
+            - token_ids (numpy array): int32 token IDs of every line, in order
+            - offsets (numpy array): int64 start of each line in token_ids,
+                plus the end of the last line
+            - columns (dict): Maps a column name (e.g., 'episode') to a tuple
+                of an int32 array with each line's code (-1 if missing) and
+                the list of labels the codes stand for
+            - has_text (numpy array): Whether each line had a document at
+                all; lines without one are left out of every document
+        '''
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.token_ids = token_ids
+        self.offsets = offsets
+        self.columns = columns
+
+        if has_text is None:
+            has_text = np.ones(self.num_lines, dtype=bool)
+        self.has_text = has_text
+
+    def __repr__(self):
+        '''
+        Returns a representation of the EncodedCorpus
+        '''
+        return 'EncodedCorpus({} lines, {} tokens, {} terms, by {})'.format(
+            self.num_lines, len(self.token_ids), len(self.vocabulary),
+            ', '.join(self.columns))
+
+    @property
+    def num_lines(self):
+        '''
+        Returns the number of lines in the corpus
+        '''
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_dataframe(cls, df, doc_col, columns):
+        '''
+        Tokenizes a column of documents and encodes it, along with the
+            columns to group lines by. Every row becomes a line, in order.
+
+        Inputs:
+            - df (pandas DataFrame): dataset with columns for documents and
+                for each grouping
+            - doc_col (str): name of the column containing the document string
+            - columns (list): names of the columns to group lines by e.g.,
+                ['episode', 'season', 'speaker']
+
+        Returns an EncodedCorpus
+        '''
+        has_text = df[doc_col].notna().to_numpy()
+        tokens = tokenizer.tokenize_series(df[doc_col])
+        lengths = tokens.str.len().fillna(0).to_numpy(dtype=np.int64)
+
+        # Token IDs in order of first appearance across the corpus
+        flat_tokens = tokens.explode().dropna()
+        token_ids, vocabulary = pd.factorize(flat_tokens, sort=False)
+
+        offsets = np.zeros(len(df) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        encoded_columns = {}
+        for column in columns:
+            codes, labels = pd.factorize(df[column], sort=False)
+            encoded_columns[column] = (codes.astype(np.int32), list(labels))
+
+        return cls(list(vocabulary), token_ids.astype(np.int32), offsets,
+                   encoded_columns, has_text)
+
+    def line(self, i):
+        '''
+        Returns the token IDs of line i, as a view (no copy)
+        '''
+        return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def column(self, column):
+        '''
+        Returns a tuple of the codes and labels of a grouping column, or
+            raises a ValueError naming the columns there are if it was not
+            encoded (e.g., None when no grouping was given)
+        '''
+        if column not in self.columns:
+            raise ValueError('No column {!r} to group lines by; choose one of '
+                             '{}'.format(column, ', '.join(self.columns)))
+
+        return self.columns[column]
+
+    def lines_of(self, column, label):
+        '''
+        Returns the indices of the lines with a given label in a column
+        '''
+        codes, labels = self.column(column)
+        code = labels.index(label)
+
+        return np.flatnonzero((codes == code) & self.has_text)
+
+    def document(self, column, label):
+        '''
+        Returns the token IDs of every line with a given label in a column
+            e.g., document('speaker', 'Steven'). The result is a view of the
+            shared array when those lines are next to each other (e.g., an
+            episode), and a copy otherwise.
+        '''
+        # Lines without a document have no tokens, so they can stay in
+        codes, labels = self.column(column)
+        lines = np.flatnonzero(codes == labels.index(label))
+
+        if len(lines) == 0:
+            return self.token_ids[:0]
+
+        if lines[-1] - lines[0] == len(lines) - 1:
+            return self.token_ids[self.offsets[lines[0]]:
+                                  self.offsets[lines[-1] + 1]]
+
+        return np.concatenate([self.line(i) for i in lines])
+
+    def group_codes(self, column):
+        '''
+        Numbers the documents of a grouping in order of first appearance,
+            counting only lines that have a document and a label.
+
+        Returns a tuple of an int64 array with each line's document number
+            (-1 if the line is left out) and the list of document labels
+        '''
+        codes, labels = self.column(column)
+        keep = (codes >= 0) & self.has_text
+
+        line_docs = np.full(self.num_lines, -1, dtype=np.int64)
+        doc_numbers, doc_codes = pd.factorize(codes[keep], sort=False)
+        line_docs[keep] = doc_numbers
+
+        return line_docs, [labels[code] for code in doc_codes]
+
+    def count_matrix(self, column):
+        '''
+        Builds a sparse document-term matrix of counts, with one document per
+            label in a column. Within each row, the columns are stored in the
+            order the terms first appear in the document, like
+            find_most_salient.build_count_matrix.
+
+        Inputs:
+            - column (str): name of the grouping e.g., 'speaker'
+
+        Returns a tuple of the list of labels (one per row) and a scipy CSR
+            matrix of counts with one column per term in the vocabulary
+        '''
+        line_docs, doc_labels = self.group_codes(column)
+        num_docs = len(doc_labels)
+        num_terms = len(self.vocabulary)
+
+        token_docs = np.repeat(line_docs, np.diff(self.offsets))
+        keep = token_docs >= 0
+        token_docs = token_docs[keep]
+        token_ids = self.token_ids[keep].astype(np.int64)
+
+        # One key per (document, term) pair; the first index of each key is
+        # where the term first appears in its document
+        keys = token_docs * num_terms + token_ids
+        unique_keys, first_index, counts = np.unique(
+            keys, return_index=True, return_counts=True)
+
+        order = np.argsort(first_index, kind='stable')
+        doc_of_key = unique_keys[order] // num_terms
+        order = order[np.argsort(doc_of_key, kind='stable')]
+
+        rows = unique_keys[order] // num_terms
+        indptr = np.zeros(num_docs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_docs), out=indptr[1:])
+
+        matrix = scipy.sparse.csr_matrix(
+            (counts[order], unique_keys[order] % num_terms, indptr),
+            shape=(num_docs, num_terms))
+
+        return doc_labels, matrix
+
+    def to_dict(self, column):
+        '''
+        Decodes a grouping into a plain corpus (a dictionary mapping each
+            label to a list of tokens), as build_simple_corpus returns it
+        '''
+        line_docs, doc_labels = self.group_codes(column)
+        documents = [[] for _ in doc_labels]
+
+        for i in np.flatnonzero(line_docs >= 0):
+            documents[line_docs[i]].extend(
+                self.vocabulary[token] for token in self.line(i))
+
+        return dict(zip(doc_labels, documents))
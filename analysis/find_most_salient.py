@@ -8,11 +8,25 @@ document frequency, which reflects how important a word is to a document in a
 collection (i.e., corpus)
 '''
 
+import sys
 import math
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
+import scipy.sparse
 import csv
-import re
+
+import clean_data
+import tokenizer
+from encoded_corpus import EncodedCorpus
+
+# Arrays shared with a worker process (see attach_shared_arrays)
+SHARED_ARRAYS = {}
+SHARED_BLOCKS = []
+
 
 def create_list_tokens(document):
     '''
@@ -24,17 +38,7 @@ def create_list_tokens(document):
 
     Returns a list of tokens
     '''
-    raw_tokens = document.split()
-    cleaned_list = []
-
-    for token in raw_tokens:
-        stripped_token = re.sub(r'[^\w\s]', '', token)
-        cleaned_token = re.sub(r'[0-9]', '', stripped_token).lower()
-
-        if cleaned_token != '':
-            cleaned_list.append(cleaned_token)
-
-    return cleaned_list
+    return tokenizer.tokenize(document)
 
 
 def count_distinct_tokens(list_of_tokens, token_counts):
@@ -71,7 +75,72 @@ def sort_by_count(token_counts, reverse=True):
     return sorted(token_counts.items(), key=lambda x: x[1], reverse=reverse)
 
 
-def calculate_tf(term, token_counts):
+def top_k(token_counts, k):
+    '''
+    Takes a dictionary of tokens and counts, and returns the k pairs with the
+        highest counts, without sorting the whole dictionary. Ties keep the
+        order of the dictionary, so the result is always the same as
+        sort_by_count(token_counts)[:k]
+
+    Inputs:
+        - token_counts (dict): Dictionary mapping token to counts (or scores)
+        - k (int): Number of pairs to return
+
+    Returns a list of tuples, sorted by value, in descending order
+    '''
+    return heapq.nlargest(k, token_counts.items(), key=lambda x: x[1])
+
+
+def top_k_indices(scores, k):
+    '''
+    Takes an array of scores and returns the positions of the k highest,
+        highest first, using a partial sort. Ties go to the earlier position,
+        as they would with a stable sort.
+
+    Inputs:
+        - scores (numpy array): 1-D array of scores
+        - k (int): Number of positions to return
+
+    Returns a numpy array of at most k positions
+    '''
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+
+    if k < len(scores):
+        # Everything that ties with the k-th highest score is a candidate
+        kth_score = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= kth_score)
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.argsort(-scores[candidates], kind='stable')[:k]
+
+    return candidates[order]
+
+
+def top_k_rows(matrix, k):
+    '''
+    Finds the k highest values in every row of a sparse matrix in one call.
+        Ties go to the entry stored first in the row.
+
+    Inputs:
+        - matrix (CSR matrix): e.g., tf-idf values from calculate_tfidf_matrix
+        - k (int): Number of entries per row
+
+    Returns a list with, for each row, a numpy array of at most k column
+        indices, highest value first
+    '''
+    rows = []
+
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        order = top_k_indices(matrix.data[start:end], k)
+        rows.append(matrix.indices[start:end][order])
+
+    return rows
+
+
+def calculate_tf(term, token_counts, max_ftd=None):
     '''
     Calculates the term frequency in a specific document. See Wikipedia entry
         for details on formula.
@@ -79,6 +148,8 @@ def calculate_tf(term, token_counts):
     Inputs:
         - term (str): Term of interest
         - token_counts (dict): Dictionary mapping terms to their frequencies
+        - max_ftd (int): The largest frequency in token_counts, if already
+            computed, so it is not found again for every term
 
     Returns the augmented term frequency, or if the term is not in the document,
         zero.
@@ -87,11 +158,124 @@ def calculate_tf(term, token_counts):
         return 0
 
     f_td = token_counts[term]
-    max_ftd = sort_by_count(token_counts)[0][1]
+    if max_ftd is None:
+        max_ftd = max(token_counts.values())
 
     return 0.5 + (0.5 * (f_td / max_ftd))
 
 
+class Corpus(dict):
+    '''
+    Class for a corpus: a dictionary mapping an identifier to a list of
+    tokens, which also keeps the number of documents each term appears in.
+    The counts are computed in a single pass and kept up to date as
+    documents are added or removed, so looking one up is O(1).
+
+    Replace a document by assigning it again; changing its list of tokens
+    in place (e.g., with extend) does not update the counts.
+
+    Example:
+        corpus = Corpus({'Gem Glow': ['cookie', 'cat'], 'Frybo': ['fries']})
+        corpus.document_frequency['cookie'] -> 1
+        corpus['Cat Fingers'] = ['cookie', 'cat', 'cookie']
+        corpus.document_frequency['cookie'] -> 2
+    '''
+
+    def __init__(self, documents=None, postings=False):
+        '''
+        Creates an instance of a Corpus.
+
+        Inputs:
+            - documents (dict): maps an identifier to a list of tokens
+            - postings (bool): whether to also keep, for each term, the set
+                of identifiers of the documents it appears in
+
+        Attributes:
+            - document_frequency (dict): Maps a term to the number of
+                documents it appears in
+            - postings (dict): Maps a term to a set of identifiers, or None
+                if postings is False
+        '''
+        super().__init__()
+        self.document_frequency = {}
+        self.postings = {} if postings else None
+
+        if documents:
+            self.update(documents)
+
+    def __setitem__(self, doc_id, tokens):
+        if doc_id in self:
+            self.remove_terms(doc_id)
+
+        super().__setitem__(doc_id, tokens)
+
+        for term in set(tokens):
+            self.document_frequency[term] = \
+                self.document_frequency.get(term, 0) + 1
+            if self.postings is not None:
+                self.postings.setdefault(term, set()).add(doc_id)
+
+    def __delitem__(self, doc_id):
+        self.remove_terms(doc_id)
+        super().__delitem__(doc_id)
+
+    def remove_terms(self, doc_id):
+        '''
+        Takes the terms of a document out of the counts (and postings)
+        '''
+        for term in set(self[doc_id]):
+            self.document_frequency[term] -= 1
+            if self.document_frequency[term] == 0:
+                del self.document_frequency[term]
+
+            if self.postings is not None:
+                self.postings[term].discard(doc_id)
+                if not self.postings[term]:
+                    del self.postings[term]
+
+    def add_document(self, doc_id, tokens):
+        '''
+        Adds a document, or replaces the one with the same identifier
+        '''
+        self[doc_id] = tokens
+
+    def remove_document(self, doc_id):
+        '''
+        Removes a document and returns its list of tokens
+        '''
+        tokens = self[doc_id]
+        del self[doc_id]
+
+        return tokens
+
+    def update(self, documents=(), **kwargs):
+        for doc_id, tokens in dict(documents, **kwargs).items():
+            self[doc_id] = tokens
+
+    def setdefault(self, doc_id, tokens=None):
+        if doc_id not in self:
+            self[doc_id] = tokens if tokens is not None else []
+
+        return self[doc_id]
+
+    def pop(self, doc_id, *default):
+        if doc_id not in self and default:
+            return default[0]
+
+        return self.remove_document(doc_id)
+
+    def popitem(self):
+        doc_id = next(reversed(self))
+
+        return doc_id, self.remove_document(doc_id)
+
+    def clear(self):
+        super().clear()
+        self.document_frequency.clear()
+        if self.postings is not None:
+            self.postings.clear()
+
+
 def count_documents_with_term(term, corpus):
     '''
     Counts the number of documents that contain the term
@@ -100,8 +284,12 @@ def count_documents_with_term(term, corpus):
         - term (str): The term of interest
         - corpus (dict): The collection of documents where the
             key is some identifier, and the value is a list of
-            tokens
+            tokens. A Corpus answers from its counts instead of
+            scanning every document.
     '''
+    if isinstance(corpus, Corpus):
+        return corpus.document_frequency.get(term, 0)
+
     num_documents=0
 
     for document, tokens in corpus.items():
@@ -117,7 +305,7 @@ def calculate_idf(term, corpus):
 
     Inputs:
         - term (str): The term of interest
-        - corpus (dict): The collection of documents where the
+        - corpus (dict or Corpus): The collection of documents where the
             key is some identifier, and the value is a list of
             tokens
     '''
@@ -126,21 +314,26 @@ def calculate_idf(term, corpus):
     return math.log(len(corpus) / docs_with_term)
 
 
-def calculate_tfidf(term, document_tokens, corpus):
+def calculate_tfidf(term, document_tokens, corpus, token_counts=None,
+                    max_ftd=None):
     '''
     Calculate the tf-idf of a term in a document, given a corpus
 
     Inputs:
     - term (str): The term of interest
     - document_tokens (list): List of tokens in a document
-    - corpus (dict): The collection of documents where the
+    - corpus (dict or Corpus): The collection of documents where the
             key is some identifier, and the value is a list of
             tokens
+    - token_counts (dict): The counts of document_tokens, if already
+            computed (see count_distinct_tokens)
+    - max_ftd (int): The largest of token_counts, if already computed
     '''
-    token_frequency_map = {}
-    count_distinct_tokens(document_tokens, token_frequency_map)
+    if token_counts is None:
+        token_counts = {}
+        count_distinct_tokens(document_tokens, token_counts)
 
-    tf = calculate_tf(term, token_frequency_map)
+    tf = calculate_tf(term, token_counts, max_ftd)
     idf = calculate_idf(term, corpus)
     tfidf = tf * idf
 
@@ -153,43 +346,62 @@ def build_dictionary(document, corpus):
 
     Inputs:
         - document (list): a list of tokens
-        - corpus (dict): maps an identifier to a list of tokens
+        - corpus (dict or Corpus): maps an identifier to a list of tokens
 
     Returns: dictionary i.e., {token: tf-idf}
     '''
     token_to_tfidf = {}
+    token_counts = {}
+    count_distinct_tokens(document, token_counts)
+    max_ftd = max(token_counts.values()) if token_counts else None
 
     for token in document:
         if token not in token_to_tfidf:
-            token_to_tfidf[token] = calculate_tfidf(token, document, corpus)
+            token_to_tfidf[token] = calculate_tfidf(token, document, corpus,
+                                                    token_counts, max_ftd)
 
     return token_to_tfidf
 
 
-def find_most_salient(corpus, k):
+def find_most_salient(corpus, k, by=None, workers=None):
     '''
     Takes a collection of documents and an integer k and returns a dictionary of
         the k most salient terms, that is, the terms with the highest tf–idf,
         for each document.
 
     Inputs:
-        - corpus (dict): maps an identifier to a list of tokens
+        - corpus (dict, Corpus or EncodedCorpus): maps an identifier to a list
+            of tokens
         - k (int): number of terms per document to pull
+        - by (str): for an EncodedCorpus, the column to group lines into
+            documents by (see find_most_salient_sparse); required, and a
+            ValueError lists the columns there are if it is missing
+        - workers (int): number of processes to score documents with (see
+            find_most_salient_parallel); None scores them in this process
 
     Returns a dictionary where the key is the identifier, and the value, a list
         of the k most salient terms
     '''
 
+    if workers is not None and workers > 1:
+        return find_most_salient_parallel(corpus, k, by, workers)
+
+    if isinstance(corpus, EncodedCorpus):
+        return find_most_salient_sparse(corpus, k, by)
+
     k_most_salient = {}
 
+    # Count the documents each term appears in once, up front
+    if not isinstance(corpus, Corpus):
+        corpus = Corpus(corpus)
+
     for doc_id, tokens in corpus.items():
         most_salient_by_doc = []
 
         if tokens:
             token_to_tfidf = build_dictionary(tokens, corpus)
-            sorted_list = sort_by_count(token_to_tfidf)
 
-            for token, count in sorted_list[:k]:
+            for token, count in top_k(token_to_tfidf, k):
                 most_salient_by_doc.append(token)
 
         k_most_salient[doc_id] = most_salient_by_doc
@@ -197,10 +409,270 @@ def find_most_salient(corpus, k):
     return k_most_salient
 
 
+def build_count_matrix(corpus):
+    '''
+    Builds the vocabulary of a corpus and a sparse document-term matrix of
+        counts, in a single pass over the tokens.
+
+    Within each row, the columns are stored in the order the terms first
+        appear in the document, so ties can be broken the same way
+        find_most_salient breaks them.
+
+    Inputs:
+        - corpus (dict): maps an identifier to a list of tokens
+
+    Returns a tuple of the list of identifiers (one per row), the list of
+        terms (one per column) and a scipy CSR matrix of counts
+    '''
+    vocabulary = {}
+    indptr = [0]
+    indices = []
+    data = []
+
+    for tokens in corpus.values():
+        token_counts = {}
+        count_distinct_tokens(tokens, token_counts)
+
+        for token, count in token_counts.items():
+            indices.append(vocabulary.setdefault(token, len(vocabulary)))
+            data.append(count)
+
+        indptr.append(len(indices))
+
+    counts = scipy.sparse.csr_matrix(
+        (np.array(data, dtype=np.int64), np.array(indices, dtype=np.int64),
+         np.array(indptr, dtype=np.int64)),
+        shape=(len(corpus), len(vocabulary)))
+
+    return list(corpus.keys()), list(vocabulary), counts
+
+
+def calculate_idf_array(counts):
+    '''
+    Calculates the vanilla inverse document frequency of every term at once
+
+    Inputs:
+        - counts (CSR matrix): document-term counts from build_count_matrix
+
+    Returns a numpy array with the idf of each term (column)
+    '''
+    num_docs = counts.shape[0]
+    docs_with_term = np.bincount(counts.indices, minlength=counts.shape[1])
+
+    # Terms in none of the documents (possible with an EncodedCorpus, whose
+    # vocabulary is shared between groupings) never get a score anyway
+    return np.array([math.log(num_docs / df) if df else 0.0
+                     for df in docs_with_term], dtype=np.float64)
+
+
+def calculate_tfidf_matrix(counts):
+    '''
+    Calculates the tf-idf of every term in every document at once, with the
+        same augmented term frequency and vanilla inverse document frequency
+        as calculate_tfidf.
+
+    Inputs:
+        - counts (CSR matrix): document-term counts from build_count_matrix
+
+    Returns a CSR matrix of tf-idf values with the same structure as counts
+    '''
+    num_docs = counts.shape[0]
+    row_lengths = np.diff(counts.indptr)
+
+    # Largest count in each document, repeated for each of its terms
+    row_max = np.zeros(num_docs, dtype=counts.data.dtype)
+    nonempty = row_lengths > 0
+    if counts.nnz:
+        row_max[nonempty] = np.maximum.reduceat(counts.data,
+                                                counts.indptr[:-1][nonempty])
+    max_ftd = np.repeat(row_max, row_lengths)
+
+    tf = 0.5 + (0.5 * (counts.data / max_ftd))
+
+    idf = calculate_idf_array(counts)
+
+    return scipy.sparse.csr_matrix(
+        (tf * idf[counts.indices], counts.indices, counts.indptr),
+        shape=counts.shape)
+
+
+def find_most_salient_sparse(corpus, k, by=None):
+    '''
+    Same as find_most_salient, but builds the document-term matrix once and
+        scores every term with array operations instead of re-scanning the
+        corpus for each term.
+
+    Inputs:
+        - corpus (dict or EncodedCorpus): maps an identifier to a list of
+            tokens
+        - k (int): number of terms per document to pull
+        - by (str): for an EncodedCorpus, the column to group lines into
+            documents by e.g., 'speaker'
+
+    Returns a dictionary where the key is the identifier, and the value, a list
+        of the k most salient terms
+    '''
+    if isinstance(corpus, EncodedCorpus):
+        vocabulary = corpus.vocabulary
+        doc_ids, counts = corpus.count_matrix(by)
+    else:
+        doc_ids, vocabulary, counts = build_count_matrix(corpus)
+    tfidf = calculate_tfidf_matrix(counts)
+
+    # Tied terms stay in the order they first appear in the document
+    top_terms = top_k_rows(tfidf, k)
+
+    return {doc_id: [vocabulary[term] for term in terms]
+            for doc_id, terms in zip(doc_ids, top_terms)}
+
+
+def share_arrays(arrays):
+    '''
+    Copies numpy arrays into shared memory blocks that other processes can
+        attach to without pickling the data
+
+    Inputs:
+        - arrays (dict): maps a name to a numpy array
+
+    Returns a tuple of the list of SharedMemory blocks (close and unlink them
+        when done) and a dictionary mapping each name to the block's name,
+        the array's shape and its dtype
+    '''
+    blocks = []
+    specs = {}
+
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, specs
+
+
+def attach_shared_arrays(specs):
+    '''
+    Runs once in each worker process: attaches to the blocks from
+        share_arrays and keeps read-only views of them in SHARED_ARRAYS. The
+        parent process owns the blocks and unlinks them when it is done.
+    '''
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+
+        array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+
+        SHARED_BLOCKS.append(block)
+        SHARED_ARRAYS[name] = array
+
+    return None
+
+
+def top_terms_for_rows(data, indices, indptr, idf, start, end, k):
+    '''
+    Scores the documents in rows start to end of a count matrix, with the
+        same tf-idf as calculate_tfidf_matrix, and picks the top k terms of
+        each
+
+    Inputs:
+        - data, indices, indptr (numpy arrays): the arrays of a CSR matrix of
+            counts from build_count_matrix
+        - idf (numpy array): idf of each term, from calculate_idf_array
+        - start, end (int): rows to score
+        - k (int): number of terms per document to pull
+
+    Returns a list with, for each row, a list of at most k term indices
+    '''
+    top_terms = []
+
+    for row in range(start, end):
+        row_start, row_end = indptr[row], indptr[row + 1]
+        row_counts = data[row_start:row_end]
+        row_terms = indices[row_start:row_end]
+
+        if len(row_counts) == 0:
+            top_terms.append([])
+            continue
+
+        tf = 0.5 + (0.5 * (row_counts / row_counts.max()))
+        scores = tf * idf[row_terms]
+
+        top_terms.append(row_terms[top_k_indices(scores, k)].tolist())
+
+    return top_terms
+
+
+def score_shared_rows(task):
+    '''
+    Runs in a worker process: scores a (start, end, k) range of rows of the
+        count matrix in SHARED_ARRAYS (see top_terms_for_rows)
+    '''
+    start, end, k = task
+
+    return top_terms_for_rows(SHARED_ARRAYS['data'], SHARED_ARRAYS['indices'],
+                              SHARED_ARRAYS['indptr'], SHARED_ARRAYS['idf'],
+                              start, end, k)
+
+
+def find_most_salient_parallel(corpus, k, by=None, workers=2,
+                               chunks_per_worker=4):
+    '''
+    Same as find_most_salient_sparse, but scores the documents in a pool of
+        worker processes. The counts and idf are built once, here, and
+        placed in shared memory, so each task only sends a range of rows.
+
+    Inputs:
+        - corpus (dict or EncodedCorpus): maps an identifier to a list of
+            tokens
+        - k (int): number of terms per document to pull
+        - by (str): for an EncodedCorpus, the column to group lines into
+            documents by
+        - workers (int): number of worker processes
+        - chunks_per_worker (int): number of row ranges per worker, so that
+            faster workers can pick up more of them
+
+    Returns a dictionary where the key is the identifier, and the value, a list
+        of the k most salient terms, in the same order as the corpus
+    '''
+    if isinstance(corpus, EncodedCorpus):
+        vocabulary = corpus.vocabulary
+        doc_ids, counts = corpus.count_matrix(by)
+    else:
+        doc_ids, vocabulary, counts = build_count_matrix(corpus)
+
+    blocks, specs = share_arrays({'data': counts.data,
+                                  'indices': counts.indices,
+                                  'indptr': counts.indptr,
+                                  'idf': calculate_idf_array(counts)})
+
+    num_docs = len(doc_ids)
+    chunk_size = max(1, math.ceil(num_docs / (workers * chunks_per_worker)))
+    tasks = [(start, min(start + chunk_size, num_docs), k)
+             for start in range(0, num_docs, chunk_size)]
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=attach_shared_arrays,
+                                 initargs=(specs,)) as executor:
+            # map returns the chunks in order, so documents keep their order
+            top_terms = list(itertools.chain.from_iterable(
+                executor.map(score_shared_rows, tasks)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return {doc_id: [vocabulary[term] for term in terms]
+            for doc_id, terms in zip(doc_ids, top_terms)}
+
+
 def clean_speaker(speaker_str):
     '''
     Takes a string representing one or more possible speakers and returns a set
-        of cleaned speakers
+        of cleaned speakers (see clean_data.parse_speaker, which caches the
+        result for each string)
 
         Examples:
         clean_speaker('Amethyst, Ruby & Sapphire') ->
@@ -214,10 +686,7 @@ def clean_speaker(speaker_str):
 
     Returns a set of clean speakers
     '''
-    speaker_set = set([speaker.strip() for speaker in
-                        re.split(', |& |and ', speaker) if speaker != ''])
-
-    return speaker_set
+    return set(clean_data.parse_speaker(speaker_str))
 
 
 def list_clean_speakers(transcripts):
@@ -229,16 +698,14 @@ def list_clean_speakers(transcripts):
 
     Returns a list of clean speaker sets e.g. [{'steven'}, {'garnet', 'pearl'}]
     '''
-    cleaned_speakers = []
+    cleaned_speakers = {}
 
     for speaker in transcripts.speaker.unique():
-    if isinstance(speaker, str):
-        speaker_set = clean_speaker(speaker)
-
-        if speaker_set not in cleaned_speakers:
-            cleaned_speakers.append(speaker_set)
+        if isinstance(speaker, str):
+            speaker_set = frozenset(clean_data.parse_speaker(speaker))
+            cleaned_speakers.setdefault(speaker_set, None)
 
-    return cleaned_speakers
+    return [set(speaker_set) for speaker_set in cleaned_speakers]
 
 
 def build_simple_corpus(df, index, doc_col, filter_by=None):
@@ -250,48 +717,52 @@ def build_simple_corpus(df, index, doc_col, filter_by=None):
         - df (pandas DataFrame): dataset with columns for index and document
         - index (str): name of the column to use as key
         - doc_col (str): name of the column containing the document string
-        - filter_by (tuple of strings): column, value to limit the data by
+        - filter_by (tuple): column, value to limit the data by; the value
+            can also be a list of values to keep
 
-    Returns a dictionary of documents mapped to their identifier
+    Returns a dictionary of documents mapped to their identifier, in the order
+        each identifier first appears
     '''
-    corpus = {}
-
     if filter_by:
-        filter_col, filter_val = limit_by
-        df = df.loc[df[filter_col] == filter_val, :]
+        filter_col, filter_val = filter_by
+        if isinstance(filter_val, (list, tuple, set)):
+            df = df.loc[df[filter_col].isin(filter_val), :]
+        else:
+            df = df.loc[df[filter_col] == filter_val, :]
 
-    df = df.loc[df[doc_col].notna(), :] # Limit the data to the rows with values
-    df['terms'] = df.apply(lambda row: create_list_tokens(row[doc_col]), axis=1)
+    has_doc = df[doc_col].notna() # Limit the data to the rows with values
+    terms = tokenizer.tokenize_series(df.loc[has_doc, doc_col])
+    keys = df.loc[has_doc, index].to_numpy()
 
-    for i in range(len(df)):
-        id = df.iloc[i][index]
-        doc = df.iloc[i]['terms']
+    corpus = {}
 
-        if id not in corpus:
-            corpus[id] = doc
-        else:
-            corpus[id].extend(doc)
+    for id, docs in terms.groupby(keys, sort=False, dropna=False):
+        corpus[id] = list(itertools.chain.from_iterable(docs))
 
     return corpus
 
 
-def build_comprehensive_corpus(trans_df, ep_df):
+def build_comprehensive_corpus(trans_df, ep_df, doc_col='quote'):
     '''
     Takes the dataframes containing data on transcripts and episodes, and
         returns a comprehensive corpus that contains documents organized by
         episode, then season, then speaker.
 
+        Every line is tokenized once, in a single pass. A line spoken by more
+        than one speaker (e.g., "Ruby & Sapphire", see clean_speaker) counts
+        for each of them.
+
         Example:
         {'Steven':
-            {'Season 1':
+            {'1':
                 {'Gem Glow': ['noooo', 'this', 'cant', 'be', 'happening'],
                  'Laser Light Cannon': ['i', 'dont', 'know', 'hmm']
                 },
-             'Season 2':
+             '2':
                 {...}
             },
         'Lars':
-            {'Season 1':
+            {'1':
                 {'Gem Glow': [...],
                  'Laser Light Cannon': [...]
                 },
@@ -301,31 +772,67 @@ def build_comprehensive_corpus(trans_df, ep_df):
     Inputs:
         - trans_df (df): a pandas DataFrame, each row a line in a transcript
         - ep_df (df): a pandas DataFrame, each row an episode in the series
+        - doc_col (str): name of the column containing the document string
 
     Returns a comprehensive corpus
     '''
-
-    corpus = {', '.join(speaker): None for speaker in trans_df.speaker.unique()}
-
     merged_df = trans_df.merge(ep_df, left_on='episode', right_on='title')
+    merged_df = merged_df.loc[merged_df[doc_col].notna() &
+                              merged_df['speaker'].notna(), :]
 
-    # Clean up speakers (in df?) and iterate through them
+    merged_df = merged_df.reset_index(drop=True)
+    terms = tokenizer.tokenize_series(merged_df[doc_col])
 
+    # Give every line one row per speaker
+    speakers, line_speakers = clean_data.normalize_speakers(merged_df)
+    line_ids = line_speakers['line_id'].to_numpy()
+    lines = pd.DataFrame({
+        'speaker': speakers['name'].to_numpy()[line_speakers['speaker_id']],
+        'season': merged_df['season'].to_numpy()[line_ids],
+        'episode': merged_df['episode'].to_numpy()[line_ids],
+        'terms': terms.to_numpy()[line_ids]})
 
-    for season in merged_df.season.unique():
-        filtered = merged_df.loc[merged_df['season']==season, :]
-        season_corpus = build_simple_corpus(filtered, episode, quote)
-        corpus[speaker][season] = season_corpus
+    corpus = {}
+    groups = lines['terms'].groupby(
+        [lines['speaker'], lines['season'], lines['episode']], sort=False)
 
+    for (speaker, season, episode), docs in groups:
+        by_season = corpus.setdefault(speaker, {})
+        by_season.setdefault(season, {})[episode] = \
+            list(itertools.chain.from_iterable(docs))
 
+    return corpus
 
 
+def aggregate_corpus(corpus, level):
+    '''
+    Takes a comprehensive corpus and joins its documents up to a coarser
+        level, without tokenizing anything again
 
+    Inputs:
+        - corpus (dict): from build_comprehensive_corpus
+        - level (str): 'episode' (no change), 'season' or 'series'
+
+    Returns a dictionary of documents by speaker, then season (for 'season')
+        e.g., {'Steven': {'1': [...], '2': [...]}}, or of one document per
+        speaker (for 'series') e.g., {'Steven': [...]}
+    '''
+    if level == 'episode':
+        return corpus
 
+    by_season = {speaker: {season: list(itertools.chain.from_iterable(
+                                episodes.values()))
+                           for season, episodes in seasons.items()}
+                 for speaker, seasons in corpus.items()}
 
+    if level == 'season':
+        return by_season
 
+    if level == 'series':
+        return {speaker: list(itertools.chain.from_iterable(seasons.values()))
+                for speaker, seasons in by_season.items()}
 
-    return corpus
+    raise ValueError("level must be 'episode', 'season' or 'series'")
 
 
 def main(k, transcripts=True):
@@ -0,0 +1,242 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file writes a tokenized transcript to disk as flat binary arrays (token
+IDs, line offsets and an ID column for each grouping), and opens it again
+with numpy.memmap. Opening a store does not read or tokenize anything: the
+arrays are paged in from the OS cache as they are used, and every process
+that opens the same store shares those pages.
+
+Each build is written to a new generation subfolder, and the meta file that
+points to it is replaced last, so processes that still have an older
+generation mapped keep reading consistent, unchanged files.
+
+Build the store once, after scraping:
+    python3 analysis/token_store.py
+'''
+
+import sys
+import os
+import json
+import shutil
+import numpy as np
+
+import clean_data
+from encoded_corpus import EncodedCorpus
+
+# config.py lives in the root of the repo, one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+# Bump when the layout of the files changes, so older stores are rebuilt
+STORE_VERSION = 2
+META_FILE = 'store.json'
+VOCABULARY_FILE = 'vocabulary.txt'
+GENERATION_PREFIX = 'generation-'
+
+# File and dtype of each flat array; grouping columns are '<column>.int32'
+ARRAYS = {'token_ids': ('token_ids.int32', np.int32),
+          'offsets': ('offsets.int64', np.int64),
+          'has_text': ('has_text.bool', np.bool_)}
+COLUMN_DTYPE = np.int32
+
+
+def add_seasons(transcripts, episodes):
+    '''
+    Takes the transcripts and episodes dataframes and returns the
+        transcripts with the season of each line's episode
+    '''
+    seasons = dict(zip(episodes['title'], episodes['season'].astype(str)))
+
+    return transcripts.assign(
+        season=transcripts['episode'].astype(object).map(seasons))
+
+
+def build_store(transcripts, folder, doc_col='quote',
+                columns=('episode', 'speaker', 'season'), source=None):
+    '''
+    Tokenizes a column of transcript lines (with the same rules as
+        find_most_salient.create_list_tokens) and writes the encoded corpus
+        to a new generation subfolder of a folder. The meta file is replaced
+        last, so a store that failed halfway is never opened, and readers of
+        the previous generation never see its files change.
+
+    Inputs:
+        - transcripts (pandas DataFrame): each row a line in a transcript,
+            with a column for each grouping (see add_seasons)
+        - folder (str): folder to write the store to; it is created if needed
+        - doc_col (str): name of the column containing the document string
+        - columns (tuple): names of the columns to group lines by
+        - source (str): path of the CSV the transcripts came from, whose hash
+            is recorded so is_current can tell when the store is out of date
+
+    Returns the EncodedCorpus that was written
+    '''
+    corpus = EncodedCorpus.from_dataframe(transcripts, doc_col, list(columns))
+
+    os.makedirs(folder, exist_ok=True)
+    previous = read_meta(folder)
+    generation = GENERATION_PREFIX + str(
+        previous['generation_number'] + 1 if previous else 0)
+    path = os.path.join(folder, generation)
+
+    # Left behind by a build that failed before its meta file was written
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    for name, (file_name, dtype) in ARRAYS.items():
+        getattr(corpus, name).astype(dtype).tofile(
+            os.path.join(path, file_name))
+
+    for column, (codes, labels) in corpus.columns.items():
+        codes.astype(COLUMN_DTYPE).tofile(
+            os.path.join(path, column + '.int32'))
+
+    # Tokens never contain whitespace, so one term per line is unambiguous
+    with open(os.path.join(path, VOCABULARY_FILE), 'w',
+              encoding='utf-8') as f:
+        f.write('\n'.join(corpus.vocabulary))
+
+    meta = {'version': STORE_VERSION,
+            'generation': generation,
+            'generation_number': int(generation[len(GENERATION_PREFIX):]),
+            'doc_col': doc_col,
+            'num_lines': corpus.num_lines,
+            'num_tokens': len(corpus.token_ids),
+            'num_terms': len(corpus.vocabulary),
+            'labels': {column: [str(label) for label in labels]
+                       for column, (codes, labels) in corpus.columns.items()},
+            'source_sha256': clean_data.hash_file(source) if source else None}
+
+    clean_data.write_json(os.path.join(folder, META_FILE), meta)
+    remove_old_generations(folder, keep=(generation,
+                                         previous and previous['generation']))
+
+    return corpus
+
+
+def remove_old_generations(folder, keep):
+    '''
+    Deletes the generation subfolders of a store other than those in keep.
+        The previous generation is kept, since a process may have read the
+        old meta file and not yet opened its arrays; processes that already
+        mapped an older one keep their pages until they close them.
+    '''
+    for name in os.listdir(folder):
+        if name.startswith(GENERATION_PREFIX) and name not in keep:
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+
+def read_meta(folder):
+    '''
+    Returns the dictionary in a store's meta file, or None if the folder
+        holds no complete store of the current version
+    '''
+    try:
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != STORE_VERSION:
+        return None
+
+    return meta
+
+
+def is_current(folder, source):
+    '''
+    Checks whether the store in a folder was built from the current contents
+        of a CSV file
+    '''
+    meta = read_meta(folder)
+
+    return meta is not None and \
+        meta['source_sha256'] == clean_data.hash_file(source)
+
+
+def open_array(folder, file_name, dtype, length):
+    '''
+    Maps one of a store's flat arrays into memory, read-only. An empty array
+        cannot be memory-mapped, so it is returned as a plain empty array.
+    '''
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(os.path.join(folder, file_name), dtype=dtype, mode='r',
+                     shape=(length,))
+
+
+def open_store(folder):
+    '''
+    Opens a store written by build_store. Only the vocabulary and labels are
+        read up front; token IDs, offsets and grouping columns are memory
+        maps, so EncodedCorpus.document and line return views into the files
+        rather than copies.
+
+        Worker processes can each open the same store (e.g., in a
+        ProcessPoolExecutor initializer) and share its pages through the OS
+        cache, instead of being sent a copy of the corpus.
+
+    Inputs:
+        - folder (str): folder the store was written to
+
+    Returns an EncodedCorpus backed by the files in the folder
+    '''
+    meta = read_meta(folder)
+    if meta is None:
+        raise FileNotFoundError('No token store in {}; build one with '
+                                'python3 analysis/token_store.py'.format(folder))
+
+    folder = os.path.join(folder, meta['generation'])
+    with open(os.path.join(folder, VOCABULARY_FILE), encoding='utf-8') as f:
+        vocabulary = f.read().split('\n') if meta['num_terms'] else []
+
+    num_lines = meta['num_lines']
+    lengths = {'token_ids': meta['num_tokens'],
+               'offsets': num_lines + 1,
+               'has_text': num_lines}
+
+    arrays = {name: open_array(folder, file_name, dtype, lengths[name])
+              for name, (file_name, dtype) in ARRAYS.items()}
+
+    columns = {}
+    for column, labels in meta['labels'].items():
+        codes = open_array(folder, column + '.int32', COLUMN_DTYPE, num_lines)
+        columns[column] = (codes, labels)
+
+    return EncodedCorpus(vocabulary, arrays['token_ids'], arrays['offsets'],
+                         columns, arrays['has_text'])
+
+
+def main(folder=None, rebuild=False):
+    '''
+    Builds the token store from the scraped CSVs, unless it is already up to
+    date, and prints a summary of it
+    '''
+    folder = folder or config.token_store_folder
+    transcripts_file = config.data_folder + 'transcripts.csv'
+
+    if rebuild or not is_current(folder, transcripts_file):
+        transcripts = clean_data.load_data(transcripts_file)
+        episodes = clean_data.load_data(config.data_folder + 'episodes.csv')
+        build_store(add_seasons(transcripts, episodes), folder,
+                    source=transcripts_file)
+        print("Built token store in", folder)
+
+    print(open_store(folder))
+
+    return None
+
+
+if __name__ == "__main__":
+    usage = "python3 analysis/token_store.py [--rebuild]"
+    args = sys.argv[1:]
+
+    if args not in ([], ['--rebuild']):
+        print(usage)
+        sys.exit(0)
+
+    main(rebuild=bool(args))
@@ -0,0 +1,79 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file splits documents into lists of lowercase tokens, stripped of
+punctuation and digits, either one document at a time or a whole column of
+documents at once.
+'''
+
+import sys
+import re
+
+# Punctuation and digits, both of which are removed from every token
+STRIP_PATTERN = re.compile(r'[^\w\s]|[0-9]')
+
+
+def tokenize(document, intern=False):
+    '''
+    Takes a document and returns a list of tokens, stripped of numeric
+        characters and punctuation.
+
+        Stripping and lowercasing the whole document before splitting it
+        gives the same tokens as doing it token by token: neither step adds
+        or removes whitespace, and tokens that end up empty disappear in the
+        split.
+
+    Inputs:
+        - document (str): A string representation of a document
+        - intern (bool): Whether to intern the tokens, so that every copy of
+            a token shares one string
+
+    Returns a list of tokens
+    '''
+    tokens = STRIP_PATTERN.sub('', document).lower().split()
+
+    if intern:
+        tokens = [sys.intern(token) for token in tokens]
+
+    return tokens
+
+
+def iter_tokenized(documents, intern=False):
+    '''
+    Takes an iterable of documents (e.g., lines of a file) and yields each
+        one's list of tokens, without holding them all in memory
+
+    Inputs:
+        - documents: iterable of strings
+        - intern (bool): Whether to intern the tokens (see tokenize)
+
+    Yields lists of tokens
+    '''
+    for document in documents:
+        yield tokenize(document, intern)
+
+
+def tokenize_series(documents, intern=False):
+    '''
+    Takes a pandas Series of documents and returns a Series with each one's
+        list of tokens, using the vectorized string methods instead of one
+        Python call per row. Missing documents stay missing.
+
+    Inputs:
+        - documents (pandas Series): Series of strings
+        - intern (bool): Whether to intern the tokens (see tokenize)
+
+    Returns a pandas Series of lists of tokens, with the same index
+    '''
+    # Object dtype keeps Python's own str.lower, so the tokens match tokenize
+    # even where the Arrow-backed string dtype would lowercase differently
+    tokens = documents.astype(object) \
+        .str.replace(STRIP_PATTERN, '', regex=True).str.lower().str.split()
+
+    if intern:
+        tokens = tokens.map(
+            lambda doc: [sys.intern(token) for token in doc], na_action='ignore')
+
+    return tokens
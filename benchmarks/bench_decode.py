@@ -0,0 +1,206 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file compares the old way of reading transcript pages (decode the
+response as ISO-8859-1, encode it back to bytes, let BeautifulSoup decode it
+again) with the byte-level path in util.read_request. Both paths use the same
+parser and SoupStrainer, so the difference is the decoding alone. It checks
+that both extract the same rows and reports the time per page, then does the
+same for the switch from html5lib to the configured parser. Last, it checks
+that a crawl with get_episode_data counts each speaker's lines the same as
+extract_transcript does.
+
+Pages come from the response cache, so run a crawl first:
+    python3 scrape_wiki.py
+    python3 benchmarks/bench_decode.py
+'''
+
+import sys
+import os
+import glob
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bs4
+
+import util
+import config
+import scrape_wiki
+
+GUIDE_URL = 'https://steven-universe.fandom.com/wiki/Episode_Guide'
+
+
+def legacy_read_request(request):
+    '''
+    The old util.read_request: force ISO-8859-1, then encode back to bytes
+    '''
+    request.encoding = 'ISO-8859-1'
+    return request.text.encode('ISO-8859-1')
+
+
+def legacy_convert_webpage(request):
+    '''
+    The old convert_webpage's decoding, with the current parser and
+    SoupStrainer: the re-encoded bytes, with no declared charset
+    '''
+    return bs4.BeautifulSoup(legacy_read_request(request),
+                             scrape_wiki.get_parser(),
+                             parse_only=scrape_wiki.TRANSCRIPT_TAGS)
+
+
+def html5lib_convert_webpage(request):
+    '''
+    The current byte-level decoding with the old parser: a full html5lib
+    parse, which ignores the SoupStrainer
+    '''
+    return bs4.BeautifulSoup(util.read_request(request), "html5lib",
+                             from_encoding=util.get_declared_charset(request))
+
+
+def current_convert_webpage(request):
+    '''
+    The current convert_webpage: byte-level decoding with the configured
+    parser and SoupStrainer
+    '''
+    return scrape_wiki.convert_webpage(request, scrape_wiki.TRANSCRIPT_TAGS)
+
+
+def load_cached_transcripts(cache):
+    '''
+    Returns a list of request objects for every cached transcript page
+    '''
+    pages = []
+
+    for path in sorted(glob.glob(os.path.join(cache.folder, 'urls', '*.json'))):
+        with open(path) as f:
+            entry = json.load(f)
+
+        if entry['url'].endswith('/Transcript'):
+            pages.append(cache.to_request(entry))
+
+    return pages
+
+
+def extract_rows(soup):
+    '''
+    Extracts the transcript rows of a page, taking the episode title from
+        the page itself
+    '''
+    title = soup.find('h1', id="firstHeading").text[:-11]
+    episode = scrape_wiki.Episode(title)
+    scrape_wiki.extract_transcript(None, episode, soup)
+
+    return episode.transcript
+
+
+def check_speaker_counts(pages):
+    '''
+    Runs get_episode_data over the cached Episode Guide and compares each
+        episode's speaker counts with those of extract_transcript on the same
+        page, so rows that are both streamed and kept are not counted twice
+
+    Returns a list of the titles whose counts differ, or None if the
+        Episode Guide is not cached
+    '''
+    util.configure_cache(config.cache_folder, offline=True)
+
+    guide = scrape_wiki.download_convert_webpage(GUIDE_URL,
+                                                 scrape_wiki.GUIDE_TAGS)
+    if guide is None:
+        return None
+
+    all_seasons = scrape_wiki.get_season_data(guide)
+    scrape_wiki.get_episode_data(guide, all_seasons)
+    crawled = {episode.title: episode for season in all_seasons
+               for episode in season.episodes}
+
+    differ = []
+    for request in pages:
+        soup = current_convert_webpage(request)
+        title = soup.find('h1', id="firstHeading").text[:-11]
+        if title not in crawled:
+            continue
+
+        episode = scrape_wiki.Episode(title)
+        scrape_wiki.extract_transcript(None, episode, soup)
+        counts = episode.speaker_counts()
+
+        if crawled[title].speaker_counts() != counts or any(
+                crawled[title].count_speaker_lines(speaker) != count
+                for speaker, count in counts.items()):
+            differ.append(title)
+
+    return differ
+
+
+def time_path(pages, convert):
+    '''
+    Converts and extracts every page with one path.
+
+    Returns the list of extracted transcripts and the seconds per page
+    '''
+    transcripts = []
+    start = time.perf_counter()
+
+    for request in pages:
+        transcripts.append(extract_rows(convert(request)))
+
+    seconds = time.perf_counter() - start
+
+    return transcripts, seconds / len(pages)
+
+
+def main():
+    '''
+    Runs both paths over the cached transcript pages and prints the results
+    '''
+    cache = util.ResponseCache(config.cache_folder, offline=True)
+    pages = load_cached_transcripts(cache)
+
+    if not pages:
+        print("No cached transcript pages in", config.cache_folder)
+        return None
+
+    old_rows, old_time = time_path(pages, legacy_convert_webpage)
+    new_rows, new_time = time_path(pages, current_convert_webpage)
+    html5lib_rows, html5lib_time = time_path(pages, html5lib_convert_webpage)
+
+    differ = [request.url for request, old, new in zip(pages, old_rows, new_rows)
+              if old != new]
+    parser_differ = [request.url for request, old, new
+                     in zip(pages, html5lib_rows, new_rows) if old != new]
+
+    print("Pages:", len(pages))
+    print("Decoding, both with the {} parser:".format(scrape_wiki.get_parser()))
+    print("    Old path: {:.1f} ms per page".format(old_time * 1000))
+    print("    New path: {:.1f} ms per page".format(new_time * 1000))
+    print("    Pages whose rows differ:", len(differ))
+    for url in differ:
+        print("        " + url)
+    print("Parser, both with byte-level decoding:")
+    print("    html5lib: {:.1f} ms per page".format(html5lib_time * 1000))
+    print("    {}: {:.1f} ms per page".format(scrape_wiki.get_parser(),
+                                              new_time * 1000))
+    print("    Pages whose rows differ:", len(parser_differ))
+    for url in parser_differ:
+        print("        " + url)
+
+    count_differ = check_speaker_counts(pages)
+    if count_differ is None:
+        print("Speaker counts: the Episode Guide is not cached, skipped")
+    else:
+        print("Speaker counts, get_episode_data against extract_transcript:")
+        print("    Episodes whose counts differ:", len(count_differ))
+        for title in count_differ:
+            print("        " + title)
+
+    return None
+
+
+if __name__ == "__main__":
+    usage = "python3 benchmarks/bench_decode.py"
+    main()
@@ -0,0 +1,210 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file builds the local data the benchmarks run on: copies of the
+scraped CSVs in data/ scaled up by repeating every episode under a new title,
+and a small set of saved wiki pages (the Episode Guide and a few transcript
+pages) in benchmarks/pages/. Nothing is downloaded.
+
+The pages committed to the repo were put together offline from the scraped
+CSVs, laid out like the wiki's pages: scripts, stylesheets, navigation,
+sidebar, infobox, navbox and footer around the tables the scraper reads.
+Replace them with pages saved from a real crawl with:
+    python3 scrape_wiki.py
+    python3 benchmarks/fixtures.py --export-pages
+'''
+
+import sys
+import os
+import glob
+import json
+import shutil
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+
+import util
+import config
+
+FIXTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'fixtures/')
+TABLES = ['seasons', 'episodes', 'transcripts']
+
+# The scraped CSVs and response cache, wherever the benchmarks are run from
+DATA_FOLDER = os.path.join(ROOT, config.data_folder)
+CACHE_FOLDER = os.path.join(ROOT, config.cache_folder or 'data/cache/')
+
+# Real wiki pages, saved from the response cache (see export_pages)
+PAGES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'pages/')
+GUIDE_URL = 'https://steven-universe.fandom.com/wiki/Episode_Guide'
+GUIDE_FILE = 'episode_guide.html'
+INDEX_FILE = 'pages.csv'
+NUM_TRANSCRIPTS = 5
+
+
+def fixture_folder(scale, folder=FIXTURE_FOLDER):
+    '''
+    Returns the folder holding the CSVs scaled by a factor e.g., 'scale_10/'
+    '''
+    return os.path.join(folder, 'scale_{}/'.format(scale))
+
+
+def copy_title(title, copy):
+    '''
+    Returns the title of the nth copy of an episode; the first copy keeps
+        the original title
+    '''
+    return title if copy == 0 else '{} (copy {})'.format(title, copy)
+
+
+def scale_tables(data_folder, scale):
+    '''
+    Reads the scraped CSVs and repeats every episode and its transcript
+        scale times, each copy under its own title. Seasons are unchanged.
+
+    Inputs:
+        - data_folder (str): folder holding the scraped CSVs
+        - scale (int): number of copies of every episode
+
+    Returns a dictionary mapping each table name to a pandas DataFrame
+    '''
+    seasons = pd.read_csv(data_folder + 'seasons.csv', dtype=str)
+    episodes = pd.read_csv(data_folder + 'episodes.csv', dtype=str)
+    transcripts = pd.read_csv(data_folder + 'transcripts.csv', dtype=str)
+
+    episode_copies = []
+    transcript_copies = []
+
+    for copy in range(scale):
+        episode_copies.append(episodes.assign(
+            title=[copy_title(title, copy) for title in episodes['title']]))
+        transcript_copies.append(transcripts.assign(
+            episode=[copy_title(title, copy)
+                     for title in transcripts['episode']]))
+
+    return {'seasons': seasons,
+            'episodes': pd.concat(episode_copies, ignore_index=True),
+            'transcripts': pd.concat(transcript_copies, ignore_index=True)}
+
+
+def write_scaled_csvs(scale, data_folder=DATA_FOLDER,
+                      folder=FIXTURE_FOLDER):
+    '''
+    Writes the CSVs scaled by a factor to their fixture folder, unless they
+        are already there
+
+    Returns the fixture folder
+    '''
+    out_folder = fixture_folder(scale, folder)
+
+    if all(os.path.exists(out_folder + table + '.csv') for table in TABLES):
+        return out_folder
+
+    os.makedirs(out_folder, exist_ok=True)
+    for table, df in scale_tables(data_folder, scale).items():
+        df.to_csv(out_folder + table + '.csv', index=False)
+
+    return out_folder
+
+
+def page_title(url):
+    '''
+    Returns the episode title of a transcript page from its URL e.g.,
+        'https://steven-universe.fandom.com/wiki/Gem_Glow/Transcript' ->
+        'Gem Glow'
+    '''
+    path = urllib.parse.urlparse(url).path
+
+    return urllib.parse.unquote(path[len('/wiki/'):-len('/Transcript')]) \
+        .replace('_', ' ')
+
+
+def export_pages(cache_folder=CACHE_FOLDER, num_transcripts=NUM_TRANSCRIPTS,
+                 folder=PAGES_FOLDER):
+    '''
+    Copies real wiki pages from the response cache (see util.ResponseCache)
+        to the saved pages folder, replacing the pages committed to the
+        repo: the Episode Guide and the first few transcript pages, in URL
+        order.
+        The pages are saved as they were downloaded, navigation, scripts
+        and all, so the parsing stages measure what the scraper really reads.
+
+    Inputs:
+        - cache_folder (str): folder of the response cache of a crawl
+        - num_transcripts (int): number of transcript pages to save
+        - folder (str): folder to save the pages to
+
+    Returns the number of pages saved
+    '''
+    cache = util.ResponseCache(cache_folder, offline=True)
+
+    guide = cache.load(GUIDE_URL)
+    if guide is None:
+        raise FileNotFoundError('The Episode Guide is not cached in {}; run a '
+                                'crawl first'.format(cache_folder))
+
+    transcripts = []
+    for path in sorted(glob.glob(os.path.join(cache.folder, 'urls', '*.json'))):
+        with open(path) as f:
+            entry = json.load(f)
+        if entry['url'].endswith('/Transcript') and \
+           os.path.isfile(cache.object_path(entry['sha256'])):
+            transcripts.append(entry)
+
+    transcripts = sorted(transcripts, key=lambda entry: entry['url'])
+    transcripts = transcripts[:num_transcripts]
+
+    os.makedirs(folder, exist_ok=True)
+    shutil.copyfile(cache.object_path(guide['sha256']),
+                    os.path.join(folder, GUIDE_FILE))
+
+    pages = []
+    for number, entry in enumerate(transcripts):
+        page_name = 'transcript_{:03d}.html'.format(number)
+        shutil.copyfile(cache.object_path(entry['sha256']),
+                        os.path.join(folder, page_name))
+        pages.append((entry['url'], page_title(entry['url']), page_name))
+
+    # Written last, so an export that failed halfway is never read
+    pd.DataFrame(pages, columns=['url', 'title', 'page']).to_csv(
+        os.path.join(folder, INDEX_FILE), index=False)
+
+    return len(pages) + 1
+
+
+def saved_pages(folder=PAGES_FOLDER):
+    '''
+    Returns a tuple of the path of the saved Episode Guide and a list of
+        (episode title, path of its transcript page) tuples, or None if no
+        pages have been exported (see export_pages)
+    '''
+    guide_file = os.path.join(folder, GUIDE_FILE)
+    index_file = os.path.join(folder, INDEX_FILE)
+
+    if not (os.path.exists(guide_file) and os.path.exists(index_file)):
+        return None
+
+    pages = pd.read_csv(index_file, dtype=str, keep_default_na=False)
+
+    return guide_file, [(title, os.path.join(folder, page_name))
+                        for title, page_name in zip(pages['title'],
+                                                    pages['page'])]
+
+
+if __name__ == "__main__":
+    usage = "python3 benchmarks/fixtures.py --export-pages [num_transcripts]"
+    args = sys.argv[1:]
+
+    if not args or args[0] != '--export-pages' or len(args) > 2:
+        print(usage)
+        sys.exit(0)
+
+    num_pages = export_pages(num_transcripts=int(args[1]) if len(args) > 1
+                             else NUM_TRANSCRIPTS)
+    print("Saved", num_pages, "pages to", PAGES_FOLDER)
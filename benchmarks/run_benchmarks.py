@@ -0,0 +1,420 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file times each stage of the pipeline on local fixture data (see
+fixtures.py): parsing saved wiki pages, loading the CSVs, building corpora,
+scoring TF-IDF and loading the database. The CSVs are scaled up 1x, 10x and
+100x; only the stages that load whole tables run at 100x, since the token
+level stages need several GB there. Each stage is timed over a few runs and
+then run once more under tracemalloc for its peak memory.
+
+Results are written as JSON and compared with a stored baseline:
+    python3 benchmarks/run_benchmarks.py                  # compare
+    python3 benchmarks/run_benchmarks.py --save-baseline  # replace baseline
+    python3 benchmarks/run_benchmarks.py --scales 1 10    # skip 100x
+
+Runs offline; the exit code is 1 if any stage is slower than the baseline by
+more than the tolerance. If the machine or library versions differ from the
+baseline's, the differences are printed and nothing fails, unless --force is
+given.
+'''
+
+import sys
+import os
+import io
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import tracemalloc
+import contextlib
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'data'))
+sys.path.insert(0, os.path.join(ROOT, 'analysis'))
+sys.path.insert(0, ROOT)
+
+import bs4
+import numpy as np
+import pandas as pd
+
+import scrape_wiki
+import create_db
+import clean_data
+import tokenizer
+import find_most_salient
+from encoded_corpus import EncodedCorpus
+
+import fixtures
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, 'baseline.json')
+RESULTS_FILE = os.path.join(BENCHMARK_FOLDER, 'results', 'latest.json')
+
+SCALES = [1, 10, 100]
+REPEATS = 3 # Timed runs per stage; the fastest is compared
+TOLERANCE = 0.25 # Slower than the baseline by more than this is a regression
+MIN_SECONDS = 0.05 # Slowdowns smaller than this are noise
+K = 10 # Terms per document for the TF-IDF stages
+
+# Parts of the environment that change timings; the platform string is
+# recorded but not compared, since it changes with every kernel patch
+TIMING_KEYS = ('python', 'processor', 'cpu_count', 'numpy', 'pandas', 'bs4',
+               'parser')
+
+# A stage prepares its input once per scale (setup, untimed), then run is
+# timed on it; a stage whose setup returns None is skipped. max_scale is the
+# largest scale the stage runs at.
+Stage = namedtuple('Stage', ['name', 'setup', 'run', 'max_scale'])
+
+
+def parse_page(path, parse_only):
+    '''
+    Reads a saved page and parses it the way scrape_wiki.convert_webpage does
+    '''
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    return bs4.BeautifulSoup(content, scrape_wiki.get_parser(),
+                             parse_only=parse_only, from_encoding='utf-8')
+
+
+def saved_pages(index):
+    '''
+    Returns one part of the saved wiki pages (see fixtures.saved_pages), or
+        None if none have been exported, so the parsing stages are skipped
+    '''
+    pages = fixtures.saved_pages()
+
+    return None if pages is None else pages[index]
+
+
+def run_season_guide(guide_file):
+    '''
+    Parses the Episode Guide and extracts the seasons
+    '''
+    return scrape_wiki.get_season_data(parse_page(guide_file,
+                                                  scrape_wiki.GUIDE_TAGS))
+
+
+def run_transcripts(pages):
+    '''
+    Parses every transcript page and extracts its rows
+    '''
+    num_rows = 0
+
+    for title, path in pages:
+        episode = scrape_wiki.Episode(title)
+        scrape_wiki.extract_transcript(
+            None, episode, parse_page(path, scrape_wiki.TRANSCRIPT_TAGS))
+        num_rows += len(episode.transcript)
+
+    return num_rows
+
+
+def load_tables(folder):
+    '''
+    Loads the typed transcripts and episodes of a fixture folder
+    '''
+    return (clean_data.load_data(folder + 'transcripts.csv', use_cache=False),
+            clean_data.load_data(folder + 'episodes.csv', use_cache=False))
+
+
+def run_database(folder):
+    '''
+    Loads the CSVs of a fixture folder into a new database
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        return create_db.load_database(os.path.join(tmp, 'bench.db'), folder)
+
+
+def run_insert_records(transcripts):
+    '''
+    Loads the transcripts into one table the original way, with extract_data
+        and insert_records
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = create_db.create_connection(os.path.join(tmp, 'bench.db'))
+        columns = ', '.join(transcripts.columns)
+        create_db.create_table(conn, 'transcripts', columns)
+        create_db.insert_records(conn, 'transcripts', columns,
+                                 create_db.extract_data(transcripts))
+        conn.commit()
+        conn.close()
+
+
+def dict_corpus(folder):
+    '''
+    Builds the speaker corpus of a fixture folder as a Corpus
+    '''
+    transcripts, _ = load_tables(folder)
+    return find_most_salient.Corpus(find_most_salient.build_simple_corpus(
+        transcripts, 'speaker', 'quote'))
+
+
+def encoded_corpus(folder):
+    '''
+    Encodes the transcripts of a fixture folder, grouped by speaker
+    '''
+    transcripts, _ = load_tables(folder)
+    return EncodedCorpus.from_dataframe(transcripts, 'quote', ['speaker'])
+
+
+STAGES = [
+    Stage('parse_season_guide',
+          lambda folder: saved_pages(0), run_season_guide, 1),
+    Stage('extract_transcripts',
+          lambda folder: saved_pages(1), run_transcripts, 1),
+    Stage('read_csv_raw',
+          lambda folder: folder + 'transcripts.csv', pd.read_csv, 100),
+    Stage('load_data_typed',
+          lambda folder: folder, load_tables, 100),
+    Stage('tokenize_series',
+          lambda folder: load_tables(folder)[0]['quote'],
+          tokenizer.tokenize_series, 10),
+    Stage('build_simple_corpus',
+          lambda folder: load_tables(folder)[0],
+          lambda df: find_most_salient.build_simple_corpus(df, 'speaker',
+                                                           'quote'), 10),
+    Stage('build_comprehensive_corpus',
+          load_tables,
+          lambda tables: find_most_salient.build_comprehensive_corpus(*tables),
+          10),
+    Stage('encode_corpus',
+          lambda folder: load_tables(folder)[0],
+          lambda df: EncodedCorpus.from_dataframe(
+              df, 'quote', ['episode', 'speaker']), 10),
+    Stage('tfidf_dict',
+          dict_corpus,
+          lambda corpus: find_most_salient.find_most_salient(corpus, K), 10),
+    Stage('tfidf_sparse',
+          encoded_corpus,
+          lambda corpus: find_most_salient.find_most_salient_sparse(
+              corpus, K, 'speaker'), 10),
+    Stage('insert_records',
+          lambda folder: pd.read_csv(folder + 'transcripts.csv'),
+          run_insert_records, 10),
+    Stage('load_database',
+          lambda folder: folder, run_database, 100),
+]
+
+
+def measure(stage, data, repeats):
+    '''
+    Runs a stage repeats times, then once more under tracemalloc. Anything
+        the stage prints is thrown away.
+
+    Returns a dictionary with the fastest and median seconds and the peak
+        memory in MB
+    '''
+    times = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            start = time.perf_counter()
+            stage.run(data)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            stage.run(data)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds': min(times),
+            'median_seconds': statistics.median(times),
+            'peak_mb': peak / 2 ** 20,
+            'repeats': repeats}
+
+
+def run_benchmarks(scales=SCALES, stages=None, repeats=REPEATS):
+    '''
+    Runs every stage at every scale it supports
+
+    Inputs:
+        - scales (list): factors to scale the CSVs by
+        - stages (list): names of the stages to run, or None for all of them
+        - repeats (int): timed runs per stage
+
+    Returns a dictionary mapping 'stage@scale' (e.g., 'tfidf_sparse@10') to
+        its results
+    '''
+    results = {}
+
+    for scale in scales:
+        folder = fixtures.write_scaled_csvs(scale)
+
+        for stage in STAGES:
+            if scale > stage.max_scale or \
+               (stages is not None and stage.name not in stages):
+                continue
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = stage.setup(folder)
+
+            if data is None:
+                print('{:<32} skipped: no saved pages; export them with '
+                      'python3 benchmarks/fixtures.py --export-pages'.format(
+                          '{}@{}'.format(stage.name, scale)), flush=True)
+                continue
+
+            # One run is plenty to see a change at the largest scales
+            result = measure(stage, data, repeats if scale < 100 else 1)
+            result['scale'] = scale
+            results['{}@{}'.format(stage.name, scale)] = result
+
+            print('{:<32} {:>9.3f}s {:>9.1f} MB'.format(
+                '{}@{}'.format(stage.name, scale), result['seconds'],
+                result['peak_mb']), flush=True)
+
+            del data
+
+    return results
+
+
+def environment():
+    '''
+    Returns a description of the machine and library versions the
+        benchmarks ran with
+    '''
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'bs4': bs4.__version__,
+            'parser': scrape_wiki.get_parser()}
+
+
+def write_results(filename, results):
+    '''
+    Writes benchmark results, with the environment they ran in, to a JSON file
+    '''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    with open(filename, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'environment': environment(),
+                   'results': results}, f, indent=2, sort_keys=True)
+
+
+def environment_changes(before, now, keys=TIMING_KEYS):
+    '''
+    Returns a dictionary mapping every key of the environment that changes
+        timings (see TIMING_KEYS) and differs between two runs to its
+        (before, now) values
+    '''
+    return {key: (before.get(key), now.get(key)) for key in keys
+            if before.get(key) != now.get(key)}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    Compares results with a baseline, stage by stage, and prints the change
+        in time and peak memory of each
+
+    Inputs:
+        - results (dict): from run_benchmarks
+        - baseline (dict): results from an earlier run
+        - tolerance (float): fraction a stage may slow down by
+
+    Returns a list of the stages that slowed down by more than the tolerance
+    '''
+    regressions = []
+
+    print('\n{:<32} {:>10} {:>10} {:>8} {:>8}'.format(
+        'stage', 'baseline', 'now', 'time', 'memory'))
+
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:<32} {:>10} {:>9.3f}s'.format(name, '-', result['seconds']))
+            continue
+
+        before = baseline[name]
+        time_ratio = result['seconds'] / max(before['seconds'], 1e-9)
+        memory_ratio = result['peak_mb'] / max(before['peak_mb'], 1e-9)
+
+        slower = time_ratio > 1 + tolerance and \
+            result['seconds'] - before['seconds'] > MIN_SECONDS
+        if slower:
+            regressions.append(name)
+
+        print('{:<32} {:>9.3f}s {:>9.3f}s {:>7.2f}x {:>7.2f}x{}'.format(
+            name, before['seconds'], result['seconds'], time_ratio,
+            memory_ratio, '  SLOWER' if slower else ''))
+
+    return regressions
+
+
+def main(scales=SCALES, stages=None, repeats=REPEATS, save_baseline=False,
+         tolerance=TOLERANCE, force=False):
+    '''
+    Runs the benchmarks, writes the results and compares them with the
+    baseline, or replaces the baseline with them. Timings from a different
+    machine or library versions are not comparable, so if the environment
+    differs from the baseline's, the changes are printed but no stage fails
+    unless force is set.
+
+    Returns the exit code: 1 if any stage regressed, 0 otherwise
+    '''
+    results = run_benchmarks(scales, stages, repeats)
+    write_results(RESULTS_FILE, results)
+    print('\nWrote results to', RESULTS_FILE)
+
+    if save_baseline:
+        write_results(BASELINE_FILE, results)
+        print('Saved baseline to', BASELINE_FILE)
+        return 0
+
+    if not os.path.exists(BASELINE_FILE):
+        print('No baseline yet; save one with --save-baseline')
+        return 0
+
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline['results'], tolerance)
+
+    changes = environment_changes(baseline.get('environment', {}),
+                                  environment())
+    if changes:
+        print('\nThe environment differs from the baseline\'s:')
+        for key, (before, now) in changes.items():
+            print('    {}: {} -> {}'.format(key, before, now))
+
+        if not force:
+            print('Not failing on the timings; save a baseline on this '
+                  'machine, or use --force to compare anyway')
+            return 0
+
+    if regressions:
+        print('\n{} stage(s) slower than the baseline: {}'.format(
+            len(regressions), ', '.join(regressions)))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the pipeline on local fixture data')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--stages', nargs='+', default=None,
+                        choices=[stage.name for stage in STAGES])
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--force', action='store_true',
+                        help='fail on regressions even if the environment '
+                             'differs from the baseline')
+    args = parser.parse_args()
+
+    sys.exit(main(args.scales, args.stages, args.repeats, args.save_baseline,
+                  args.tolerance, args.force))
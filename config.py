@@ -1,2 +1,19 @@
 data_folder = './data/'
 database_name = data_folder + 'gems.db'
+
+# Scraper settings
+max_workers = 8 # Number of pages to download at the same time
+requests_per_second = 4 # Most requests to send to any one host per second
+request_timeout = 30 # Seconds
+max_retries = 3 # Retries on 429 and 5xx responses, with exponential backoff
+cache_folder = data_folder + 'cache/' # Set to None to turn off the cache
+offline = False # Serve pages only from the cache
+html_parser = 'lxml' # Falls back to 'html5lib', which is slower, if missing
+sink = 'csv' # Write the crawl to CSVs, or 'sqlite' for scrape_database; same as --sqlite
+scrape_database = data_folder + 'scrape.db'
+token_store_folder = data_folder + 'token_store/' # Built by analysis/token_store.py
+
+# Logging and profiling (see instrument.py)
+log_level = 'INFO' # 'DEBUG' shows every page and row; same as --verbose
+profile = False # Profile a crawl with cProfile; same as --profile
+trace_memory = False # Trace a crawl's memory with tracemalloc; same as --trace-memory
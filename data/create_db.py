@@ -3,13 +3,93 @@ STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
 
 Author: Charmaine Runes
 
-This files creates a connection to the Gems database.
+This files creates a connection to the Gems database and loads the CSVs
+from the scraper into it.
 '''
 
+import sys
+import os
+import csv
+import time
+import ast
 import sqlite3
 from sqlite3 import Error
-import pandas as pd
-import re
+
+# config.py lives in the root of the repo, one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+
+CHUNK_SIZE = 5000 # Rows per executemany call
+
+# Column definitions of each table, in load order. Every table has an
+# integer primary key; lines refer to episodes, seasons and speakers by id,
+# and each action of a line is its own row in actions.
+SCHEMA = [
+    ('seasons', 'season_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, '
+                'num_episodes INTEGER, start_date TEXT, end_date TEXT'),
+    # num_series and num_season are labels: double episodes read e.g. "98/99"
+    ('episodes', 'episode_id INTEGER PRIMARY KEY, '
+                 'season_id INTEGER NOT NULL REFERENCES seasons (season_id), '
+                 'title TEXT NOT NULL UNIQUE, num_series TEXT, '
+                 'num_season TEXT, airdate TEXT, summary TEXT'),
+    ('speakers', 'speaker_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE'),
+    ('lines', 'line_id INTEGER PRIMARY KEY, '
+              'episode_id INTEGER NOT NULL REFERENCES episodes (episode_id), '
+              'season_id INTEGER NOT NULL REFERENCES seasons (season_id), '
+              'speaker_id INTEGER REFERENCES speakers (speaker_id), '
+              'quote TEXT, location TEXT, description TEXT'),
+    ('actions', 'line_id INTEGER NOT NULL REFERENCES lines (line_id), '
+                'position INTEGER NOT NULL, action TEXT NOT NULL, '
+                'PRIMARY KEY (line_id, position)'),
+]
+
+# Column names of each table, as insert_records expects them
+COLUMNS = {
+    'seasons': 'season_id, name, num_episodes, start_date, end_date',
+    'episodes': 'episode_id, season_id, title, num_series, num_season, '
+                'airdate, summary',
+    'speakers': 'speaker_id, name',
+    'lines': 'line_id, episode_id, season_id, speaker_id, quote, location, '
+             'description',
+    'actions': 'line_id, position, action',
+}
+
+# Indexes to build once every table is loaded: (name, table, columns). The
+# line_id rides along in every index on lines, so per-episode, per-speaker
+# and per-season counts never touch the table itself.
+INDEXES = [('episodes_season_idx', 'episodes', 'season_id'),
+           ('lines_episode_idx', 'lines', 'episode_id, speaker_id'),
+           ('lines_speaker_idx', 'lines', 'speaker_id, episode_id'),
+           ('lines_season_speaker_idx', 'lines', 'season_id, speaker_id')]
+
+# Full-text index over the text columns of lines. It reads its text from
+# lines itself (an external content table), so quotes are stored only once.
+# The ids are kept, unindexed, so matches can be joined to episodes, seasons
+# and speakers.
+FTS_TABLE = 'lines_fts'
+FTS_COLUMNS = 'quote, location, description, episode_id UNINDEXED, ' \
+              'season_id UNINDEXED, speaker_id UNINDEXED'
+
+SEARCH_SQL = '''
+SELECT lines_fts.rowid, episodes.title, seasons.name, speakers.name,
+       snippet(lines_fts, -1, '[', ']', '...', {snippet_tokens}),
+       bm25(lines_fts)
+FROM lines_fts
+JOIN episodes ON episodes.episode_id = lines_fts.episode_id
+JOIN seasons ON seasons.season_id = lines_fts.season_id
+LEFT JOIN speakers ON speakers.speaker_id = lines_fts.speaker_id
+WHERE lines_fts MATCH ?
+ORDER BY bm25(lines_fts)
+LIMIT ?;
+'''
+
+USAGE = 'python3 data/create_db.py [search [--raw] <query>]'
+
+PRAGMAS = ['PRAGMA foreign_keys = ON;',
+           'PRAGMA journal_mode = WAL;',
+           'PRAGMA synchronous = NORMAL;',
+           'PRAGMA cache_size = -65536;', # 64 MB
+           'PRAGMA temp_store = MEMORY;']
 
 def create_connection(db_file):
     '''
@@ -30,7 +110,7 @@ def create_connection(db_file):
     return conn
 
 
-def create_table(conn, table_name, columns):
+def create_table(conn, table_name, columns, raise_errors=False):
     '''
     Creates a table
 
@@ -39,6 +119,8 @@ def create_table(conn, table_name, columns):
         - table_name (str): name of the table which also corresponds to csv
                             e.g., 'seasons', 'episodes', 'transcripts'
         - columns (list): column names from the csv
+        - raise_errors (bool): whether to raise a failed statement instead of
+            printing it, e.g., so a transaction can be rolled back
 
     Returns None, creates table in database
     '''
@@ -53,6 +135,8 @@ def create_table(conn, table_name, columns):
         c.execute(create_command)
 
     except Error as e:
+        if raise_errors:
+            raise
         print(e)
 
 
@@ -68,7 +152,7 @@ def extract_data(table_data):
     return list(table_data.itertuples(index=False, name=None))
 
 
-def insert_records(conn, table, columns, records):
+def insert_records(conn, table, columns, records, raise_errors=False):
     '''
     Insert multiple records of data into table
 
@@ -77,9 +161,14 @@ def insert_records(conn, table, columns, records):
         - table (str): name of the table / csv e.g. INMT4AA1
         - columns (str): column names from the csv
         - records (list): tuples from extract_data to insert into table
+        - raise_errors (bool): whether to raise a failed insert (e.g., a
+            broken UNIQUE or FOREIGN KEY constraint) instead of printing it
 
-    Returns: None (updates table in database)
+    Returns: the number of rows inserted (updates table in database)
     '''
+    if not records:
+        return 0
+
     try:
         c = conn.cursor()
         multiplier = len(columns.split(", "))
@@ -88,29 +177,437 @@ def insert_records(conn, table, columns, records):
         sql += '({});'.format(values)
         c.executemany(sql, records)
 
+        return c.rowcount
+
     except Error as e:
+        if raise_errors:
+            raise
         print(e)
 
+    return 0
+
 
-def main():
+def set_pragmas(conn):
     '''
-    Note: just for testing
+    Tunes the connection for bulk loading: write-ahead logging, fewer
+    fsyncs and a larger page cache (see PRAGMAS)
+
+    Inputs:
+        - conn: Connection object
+
+    Returns None
     '''
-    conn = create_connection(config.database_name)
-    table_name = 'test'
-    test_df = pd.DataFrame({'name': ['John', 'Karen'], 'age': [41, 32]})
-    columns = test_df.columns
-    columns = ', '.join(columns)
+    c = conn.cursor()
+    for pragma in PRAGMAS:
+        c.execute(pragma)
+
 
+def to_null(value):
+    '''
+    Returns None for an empty CSV field, so it is stored as NULL
+    '''
+    return value if value != '' else None
+
+
+def iter_chunks(rows, chunk_size=CHUNK_SIZE):
+    '''
+    Groups an iterable of rows into lists of at most chunk_size rows
+
+    Inputs:
+        - rows: iterable of rows e.g., a csv.DictReader
+        - chunk_size (int): largest number of rows per list
+
+    Yields lists of rows
+    '''
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def drop_tables(conn):
+    '''
+    Drops every table in SCHEMA, children first so no foreign key breaks
+
+    Inputs:
+        - conn: Connection object
+
+    Returns None
+    '''
     c = conn.cursor()
-    c.execute("DROP TABLE IF EXISTS test;")
-    c.execute("CREATE TABLE IF NOT EXISTS test (name,age);")
+    for table_name, _ in reversed(SCHEMA):
+        c.execute('DROP TABLE IF EXISTS {};'.format(table_name))
 
-    records = extract_data(test_df)
-    insert_records(conn,table_name,columns,records)
 
-    conn.commit()
-    conn.close()
+def load_seasons(conn, csv_file):
+    '''
+    Loads seasons.csv into the seasons table
+
+    Inputs:
+        - conn: Connection object
+        - csv_file (str): path of seasons.csv
+
+    Returns a tuple of a dictionary mapping each season name to its
+        season_id and the number of rows inserted
+    '''
+    season_ids = {}
+    records = []
+
+    with open(csv_file, newline='') as f:
+        for season_id, row in enumerate(csv.DictReader(f), start=1):
+            season_ids[row['name']] = season_id
+            records.append((season_id, row['name'],
+                            int(row['num_episodes']),
+                            to_null(row['start_date']),
+                            to_null(row['end_date'])))
+
+    num_rows = insert_records(conn, 'seasons', COLUMNS['seasons'], records,
+                              raise_errors=True)
+
+    return season_ids, num_rows
+
+
+def load_episodes(conn, csv_file, season_ids):
+    '''
+    Loads episodes.csv into the episodes table
+
+    Inputs:
+        - conn: Connection object
+        - csv_file (str): path of episodes.csv
+        - season_ids (dict): maps a season name to its season_id
+
+    Returns a tuple of a dictionary mapping each episode title to a tuple of
+        its episode_id and season_id, and the number of rows inserted
+    '''
+    episode_ids = {}
+    records = []
+
+    with open(csv_file, newline='') as f:
+        for episode_id, row in enumerate(csv.DictReader(f), start=1):
+            season_id = season_ids[row['season']]
+            episode_ids[row['title']] = (episode_id, season_id)
+            records.append((episode_id, season_id, row['title'],
+                            to_null(row['num_series']),
+                            to_null(row['num_season']),
+                            to_null(row['airdate']),
+                            to_null(row['summary'])))
+
+    num_rows = insert_records(conn, 'episodes', COLUMNS['episodes'], records,
+                              raise_errors=True)
+
+    return episode_ids, num_rows
+
+
+def load_lines(conn, csv_file, episode_ids, chunk_size=CHUNK_SIZE):
+    '''
+    Streams transcripts.csv into the speakers, lines and actions tables, one
+    chunk of rows at a time, so the file is never held in memory as a whole.
+    Speakers are stored as they are written in the transcript
+    e.g., "Ruby & Sapphire" is a single speaker.
+
+    Inputs:
+        - conn: Connection object
+        - csv_file (str): path of transcripts.csv
+        - episode_ids (dict): maps an episode title to its episode_id and
+            season_id
+        - chunk_size (int): number of rows per executemany call
+
+    Returns a dictionary mapping each table to the number of rows inserted
+    '''
+    speaker_ids = {}
+    line_id = 0
+    row_counts = {'speakers': 0, 'lines': 0, 'actions': 0}
+
+    with open(csv_file, newline='') as f:
+        for chunk in iter_chunks(csv.DictReader(f), chunk_size):
+            new_speakers = []
+            lines = []
+            actions = []
+
+            for row in chunk:
+                if row['episode'] not in episode_ids:
+                    print('Skipped a line from unknown episode:', row['episode'])
+                    continue
+
+                episode_id, season_id = episode_ids[row['episode']]
+                line_id += 1
+
+                speaker = to_null(row['speaker'])
+                if speaker is not None and speaker not in speaker_ids:
+                    speaker_ids[speaker] = len(speaker_ids) + 1
+                    new_speakers.append((speaker_ids[speaker], speaker))
+
+                lines.append((line_id, episode_id, season_id,
+                              speaker_ids.get(speaker),
+                              to_null(row['quote']),
+                              to_null(row['location']),
+                              to_null(row['description'])))
+
+                # Actions were written out as a Python list e.g., "['sighs']"
+                if row['actions'] not in ('', '[]'):
+                    for position, action in enumerate(
+                            ast.literal_eval(row['actions'])):
+                        actions.append((line_id, position, action))
+
+            # Speakers go in first, so every line's speaker_id exists
+            row_counts['speakers'] += insert_records(
+                conn, 'speakers', COLUMNS['speakers'], new_speakers,
+                raise_errors=True)
+            row_counts['lines'] += insert_records(
+                conn, 'lines', COLUMNS['lines'], lines, raise_errors=True)
+            row_counts['actions'] += insert_records(
+                conn, 'actions', COLUMNS['actions'], actions,
+                raise_errors=True)
+
+    return row_counts
+
+
+def create_indexes(conn, indexes=INDEXES):
+    '''
+    Creates every index in indexes
+
+    Inputs:
+        - conn: Connection object
+        - indexes (list): (index name, table, columns) tuples
+
+    Returns None
+    '''
+    c = conn.cursor()
+
+    for index_name, table_name, columns in indexes:
+        c.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({});'
+                  .format(index_name, table_name, columns))
+
+
+def create_fts_index(conn):
+    '''
+    Creates the FTS5 full-text index over the quotes, locations and
+    descriptions in lines, and fills it from the lines table
+
+    Inputs:
+        - conn: Connection object
+
+    Returns None
+    '''
+    c = conn.cursor()
+    c.execute('DROP TABLE IF EXISTS {};'.format(FTS_TABLE))
+    c.execute('CREATE VIRTUAL TABLE {} USING fts5({}, content=lines, '
+              'content_rowid=line_id);'.format(FTS_TABLE, FTS_COLUMNS))
+    c.execute("INSERT INTO {0} ({0}) VALUES ('rebuild');".format(FTS_TABLE))
+
+
+def to_fts_query(text):
+    '''
+    Turns plain text into an FTS5 query that matches lines containing every
+    word, by quoting each word as an FTS5 string. Punctuation then needs no
+    escaping e.g., "Steven?", "don't", "cookie-cat".
+
+    Inputs:
+        - text (str): words to search for
+
+    Returns the FTS5 query, or '' if there are no words
+    '''
+    return ' '.join('"{}"'.format(word.replace('"', '""'))
+                    for word in text.split())
+
+
+def search_lines(conn, query, limit=20, snippet_tokens=12, raw=False):
+    '''
+    Searches the quotes, locations and descriptions of every line, best
+    match first (BM25)
+
+    Inputs:
+        - conn: Connection object
+        - query (str): words to search for e.g., 'cookie cat', matched as
+            plain text (see to_fts_query), or with raw, an FTS5 query e.g.,
+            '"cookie cat"', 'quote: strawberry'
+        - limit (int): largest number of lines to return
+        - snippet_tokens (int): number of words around the match to show
+        - raw (bool): whether query is FTS5 syntax rather than plain text
+
+    Returns a list of dictionaries, one per line, with its line_id, episode,
+        season, speaker, snippet (matches in [brackets]) and rank (lower is
+        better)
+
+    Example:
+        search_lines(conn, 'cookie cat', limit=1) ->
+            [{'line_id': 30181, 'episode': 'The Future', 'season': 'Future',
+              'speaker': 'Amethyst', 'snippet': '[Cookie] [Cat]!',
+              'rank': -19.19}]
+    '''
+    if not raw:
+        query = to_fts_query(query)
+        if not query:
+            return []
+
+    c = conn.cursor()
+    c.execute(SEARCH_SQL.format(snippet_tokens=int(snippet_tokens)),
+              (query, limit))
+
+    keys = ['line_id', 'episode', 'season', 'speaker', 'snippet', 'rank']
+
+    return [dict(zip(keys, row)) for row in c.fetchall()]
+
+
+def count_speaker_lines(conn, by='episode'):
+    '''
+    Counts the lines of every speaker in every episode (or season) in one
+    query, answered from the covering indexes on lines
+
+    Inputs:
+        - conn: Connection object
+        - by (str): 'episode' or 'season'
+
+    Returns a dictionary mapping (episode title or season name, speaker) to
+        the number of lines
+    '''
+    if by == 'episode':
+        sql = '''SELECT episodes.title, speakers.name, counts.num_lines
+                 FROM (SELECT episode_id, speaker_id, COUNT(*) AS num_lines
+                       FROM lines WHERE speaker_id IS NOT NULL
+                       GROUP BY episode_id, speaker_id) AS counts
+                 JOIN episodes ON episodes.episode_id = counts.episode_id
+                 JOIN speakers ON speakers.speaker_id = counts.speaker_id;'''
+    elif by == 'season':
+        sql = '''SELECT seasons.name, speakers.name, counts.num_lines
+                 FROM (SELECT season_id, speaker_id, COUNT(*) AS num_lines
+                       FROM lines WHERE speaker_id IS NOT NULL
+                       GROUP BY season_id, speaker_id) AS counts
+                 JOIN seasons ON seasons.season_id = counts.season_id
+                 JOIN speakers ON speakers.speaker_id = counts.speaker_id;'''
+    else:
+        raise ValueError("by must be 'episode' or 'season'")
+
+    c = conn.cursor()
+    c.execute(sql)
+
+    return {(group, speaker): num_lines
+            for group, speaker, num_lines in c.fetchall()}
+
+
+def report_rate(name, num_rows, start):
+    '''
+    Prints how many rows were loaded since start, and how fast
+    '''
+    seconds = time.perf_counter() - start
+    print('Loaded {} rows into {} ({:,.0f} rows/s)'.format(
+        num_rows, name, num_rows / seconds if seconds else 0))
+
+
+def load_database(db_file, data_folder, chunk_size=CHUNK_SIZE):
+    '''
+    Creates the tables in SCHEMA and loads seasons.csv, episodes.csv and
+    transcripts.csv into them in a single transaction, then builds the
+    indexes
+
+    Inputs:
+        - db_file (str): database name (see config file)
+        - data_folder (str): folder holding the CSVs (see config file)
+        - chunk_size (int): number of rows per executemany call
+
+    Returns a dictionary mapping each table to the number of rows loaded
+    '''
+    conn = create_connection(db_file)
+    conn.isolation_level = None # Manage the transaction by hand
+    set_pragmas(conn)
+
+    c = conn.cursor()
+    c.execute('BEGIN;')
+
+    try:
+        drop_tables(conn)
+        for table_name, columns in SCHEMA:
+            create_table(conn, table_name, columns, raise_errors=True)
+
+        start = time.perf_counter()
+        season_ids, num_seasons = load_seasons(conn,
+                                               data_folder + 'seasons.csv')
+        report_rate('seasons', num_seasons, start)
+
+        start = time.perf_counter()
+        episode_ids, num_episodes = load_episodes(
+            conn, data_folder + 'episodes.csv', season_ids)
+        report_rate('episodes', num_episodes, start)
+
+        start = time.perf_counter()
+        row_counts = load_lines(conn, data_folder + 'transcripts.csv',
+                                episode_ids, chunk_size)
+        report_rate('speakers, lines and actions',
+                    sum(row_counts.values()), start)
+
+        start = time.perf_counter()
+        create_indexes(conn)
+        print('Created indexes in {:.2f}s'.format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        create_fts_index(conn)
+        print('Created full-text index in {:.2f}s'.format(
+            time.perf_counter() - start))
+
+        c.execute('COMMIT;')
+
+    except Exception:
+        c.execute('ROLLBACK;')
+        raise
+
+    finally:
+        conn.close()
+
+    row_counts['seasons'] = num_seasons
+    row_counts['episodes'] = num_episodes
+
+    return row_counts
+
+
+def main(query=None, raw=False):
+    '''
+    Loads the scraped CSVs into the Gems database, or, given a query,
+    searches the transcripts in it (as plain text, or FTS5 syntax with raw)
+    '''
+    if query is not None:
+        conn = create_connection(config.database_name)
+        start = time.perf_counter()
+        try:
+            results = search_lines(conn, query, raw=raw)
+        except sqlite3.OperationalError as e:
+            print('Search failed:', e)
+            print(USAGE)
+            return None
+        finally:
+            conn.close()
+        seconds = time.perf_counter() - start
+
+        for result in results:
+            print('{episode} (season {season}) - {speaker}: {snippet}'
+                  .format(**result))
+        print('{} lines in {:.1f} ms'.format(len(results), seconds * 1000))
+
+        return None
+
+    start = time.perf_counter()
+    row_counts = load_database(config.database_name, config.data_folder)
+    seconds = time.perf_counter() - start
+
+    total_rows = sum(row_counts.values())
+    print('Loaded {} rows in {:.2f}s ({:,.0f} rows/s)'.format(
+        total_rows, seconds, total_rows / seconds if seconds else 0))
 
 if __name__ == '__main__':
-    main()
+    args = sys.argv[1:]
+
+    if not args:
+        main()
+    elif args[:2] == ['search', '--raw'] and len(args) > 2:
+        main(' '.join(args[2:]), raw=True)
+    elif args[0] == 'search' and len(args) > 1:
+        main(' '.join(args[1:]))
+    else:
+        print(USAGE)
+        sys.exit(0)
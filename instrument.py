@@ -0,0 +1,241 @@
+'''
+STEVEN UNIVERSE: Scrape Steven Universe Wiki and analyze transcripts
+
+Author: Charmaine Runes
+
+This file sets up logging for the scraper and keeps its measurements: time
+spent in each stage of a crawl (fetch, decode, parse, extract, write),
+counters such as bytes downloaded, and the number of rows of every episode.
+It can also profile a whole run with cProfile and tracemalloc.
+'''
+
+import io
+import sys
+import time
+import logging
+import threading
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+# Stages of a crawl, in the order a page goes through them
+STAGES = ('fetch', 'decode', 'parse', 'extract', 'write')
+
+
+def configure_logging(level=logging.INFO):
+    '''
+    Sends log records from every module to stderr
+
+    Inputs:
+        - level (int or str): lowest level to show e.g., logging.DEBUG or
+            'DEBUG'
+    '''
+    logging.basicConfig(level=level, format=LOG_FORMAT, force=True)
+
+
+class StageStats():
+    '''
+    Records how long each stage of a crawl took, how often it ran, named
+    counters and the number of rows of each episode. Can be shared between
+    threads; fetch times from concurrent downloads add up, so they can be
+    more than the wall-clock time of the crawl.
+    '''
+
+    def __init__(self):
+        '''
+        Creates an instance of StageStats.
+
+        Attributes:
+            - seconds (dict): Maps a stage to the total seconds spent in it
+            - calls (dict): Maps a stage to the number of times it ran
+            - counters (dict): Maps a name (e.g., 'bytes_downloaded') to a
+                running total
+            - episode_rows (dict): Maps an episode title to the number of
+                transcript rows extracted from its page
+        '''
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears every measurement
+        '''
+        with self.lock:
+            self.seconds = {}
+            self.calls = {}
+            self.counters = {}
+            self.episode_rows = {}
+
+    def add_time(self, stage, seconds):
+        '''
+        Records one run of a stage that took a number of seconds
+        '''
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''
+        Times the code in a with block as one run of a stage e.g.,
+            with STATS.timer('parse'):
+                soup = bs4.BeautifulSoup(...)
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        '''
+        Adds n to a counter
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_episode(self, title, num_rows):
+        '''
+        Records the number of transcript rows extracted for an episode
+        '''
+        with self.lock:
+            self.episode_rows[title] = num_rows
+
+    def report(self):
+        '''
+        Returns a string with the time and runs of each stage, the counters
+            and a summary of rows per episode
+        '''
+        with self.lock:
+            seconds = dict(self.seconds)
+            calls = dict(self.calls)
+            counters = dict(self.counters)
+            rows = list(self.episode_rows.values())
+
+        stages = [stage for stage in STAGES if stage in seconds] + \
+                 sorted(stage for stage in seconds if stage not in STAGES)
+
+        lines = ["Stage          seconds     runs   ms/run"]
+        for stage in stages:
+            lines.append("{:<12} {:>9.3f} {:>8} {:>8.1f}".format(
+                stage, seconds[stage], calls[stage],
+                1000 * seconds[stage] / calls[stage]))
+
+        for name in sorted(counters):
+            lines.append("{}: {:,}".format(name, counters[name]))
+
+        if rows:
+            lines.append("{} episodes, {:,} rows (min {}, max {}, mean {:.0f})"
+                         .format(len(rows), sum(rows), min(rows), max(rows),
+                                 sum(rows) / len(rows)))
+
+        return "\n".join(lines)
+
+
+STATS = StageStats()
+
+
+class Profiler():
+    '''
+    Profiles a block of code with cProfile, tracemalloc or both, and reports
+    the functions that took the most time and the lines that allocated the
+    most memory. Does nothing when neither is turned on.
+
+    The CPU profile covers threads started inside the block too, such as the
+    download threads of util.iter_requests, so fetching shows up in it.
+    From Python 3.12 one cProfile sees every thread; before that, each new
+    thread gets a profile of its own, merged into the report. Cumulative
+    times then add up across threads.
+
+    Example:
+        with Profiler(cpu=True) as profiler:
+            main()
+        print(profiler.report())
+    '''
+
+    def __init__(self, cpu=False, memory=False, top=25):
+        '''
+        Creates an instance of a Profiler.
+
+        Attributes:
+            - cpu (bool): Whether to profile with cProfile
+            - memory (bool): Whether to trace allocations with tracemalloc
+            - top (int): Number of functions and lines to report
+            - profile (cProfile.Profile): The profile, once started
+            - thread_profiles (list): Profiles of the threads started while
+                profiling, before Python 3.12
+            - snapshot (tracemalloc.Snapshot): Allocations still held when
+                profiling stopped
+            - peak (int): Most bytes traced at once
+        '''
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.profile = None
+        self.thread_profiles = []
+        self.snapshot = None
+        self.peak = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        if self.cpu:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+            # Before 3.12 cProfile only sees the thread that enabled it
+            if sys.version_info < (3, 12):
+                threading.setprofile(self.profile_thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+            threading.setprofile(None)
+        if self.memory:
+            self.snapshot = tracemalloc.take_snapshot()
+            _, self.peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        return False
+
+    def profile_thread(self, frame, event, arg):
+        '''
+        Runs once at the start of each thread started while profiling (see
+        threading.setprofile), and gives the thread a profile of its own
+        '''
+        sys.setprofile(None)
+
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+        profile.enable()
+
+    def report(self):
+        '''
+        Returns a string with the top functions by cumulative time and the
+            top lines by memory held, for whichever profilers ran
+        '''
+        sections = []
+
+        if self.profile is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=stream)
+            for profile in self.thread_profiles:
+                stats.add(profile)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            sections.append(stream.getvalue().strip())
+
+        if self.snapshot is not None:
+            lines = ["Peak traced memory: {:.1f} MB".format(self.peak / 2 ** 20),
+                     "Top {} lines by memory held at the end:".format(self.top)]
+            for stat in self.snapshot.statistics('lineno')[:self.top]:
+                lines.append("    " + str(stat))
+            sections.append("\n".join(lines))
+
+        return "\n\n".join(sections)
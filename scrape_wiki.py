@@ -12,14 +12,97 @@ import os
 import csv
 import bs4
 import re
+import time
 import datetime
+import logging
+import hashlib
+import json
+import importlib.util
+import sqlite3
+import contextlib
+import itertools
+import collections
 
 import util
 import config
+import instrument
 
 LIMITING_DOMAIN = "https://steven-universe.fandom.com"
 DATA_FILEPATH = "/Users/charmainerunes/git/steven-universe/data/"
 
+# Only build the parts of each page that get parsed (see convert_webpage)
+GUIDE_TAGS = bs4.SoupStrainer('table')
+TRANSCRIPT_TAGS = bs4.SoupStrainer(['h1', 'table'])
+
+# Columns of each CSV, in order
+SEASON_COLUMNS = ['name', 'num_episodes', 'start_date', 'end_date']
+EPISODE_COLUMNS = ['title', 'season', 'num_series', 'num_season', 'airdate',
+                   'summary']
+TRANSCRIPT_COLUMNS = ['episode', 'speaker', 'actions', 'quote', 'location',
+                      'description']
+
+# One line of a transcript, as iter_transcript_rows yields it
+TranscriptRow = collections.namedtuple('TranscriptRow', TRANSCRIPT_COLUMNS)
+
+logger = logging.getLogger(__name__)
+
+# Versions of every TranscriptList, so no two states ever share a version
+TRANSCRIPT_VERSIONS = itertools.count()
+
+
+def _changes_transcript(name):
+    '''
+    Returns the list method called name, wrapped so that it also gives the
+    TranscriptList a new version
+    '''
+    method = getattr(list, name)
+
+    def changing_method(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.changed()
+        return result
+
+    changing_method.__name__ = name
+    changing_method.__doc__ = method.__doc__
+
+    return changing_method
+
+
+class TranscriptList(list):
+    '''
+    Class for the list of rows of an Episode's transcript. It is a list,
+    except that every change to it (setting, deleting, adding, removing or
+    reordering rows) gives it a new version, which is how Episode and Season
+    know when their speaker counts are out of date.
+    '''
+
+    def __init__(self, rows=()):
+        super().__init__(rows)
+        self.changed()
+
+    def changed(self):
+        '''
+        Gives the list a new version; call it after editing a row in place
+        (see Episode.invalidate_speaker_index)
+        '''
+        self.version = next(TRANSCRIPT_VERSIONS)
+
+        return None
+
+    __setitem__ = _changes_transcript('__setitem__')
+    __delitem__ = _changes_transcript('__delitem__')
+    __iadd__ = _changes_transcript('__iadd__')
+    __imul__ = _changes_transcript('__imul__')
+    append = _changes_transcript('append')
+    extend = _changes_transcript('extend')
+    insert = _changes_transcript('insert')
+    pop = _changes_transcript('pop')
+    remove = _changes_transcript('remove')
+    clear = _changes_transcript('clear')
+    sort = _changes_transcript('sort')
+    reverse = _changes_transcript('reverse')
+
+
 class Season():
     '''
     Class for a Season. See Constructor for attributes.
@@ -43,6 +126,9 @@ class Season():
         self.end_date = None
         self.episodes = []
 
+        self._speaker_counts = None # See speaker_counts
+        self._speaker_counts_key = None
+
     def __repr__(self):
         '''
         Returns a representation of the Season
@@ -54,6 +140,35 @@ class Season():
 
         return repr(repr_name)
 
+    def speaker_counts(self):
+        '''
+        Returns a Counter mapping each speaker to the number of lines they
+        speak in the season, summed from each Episode's index. It is kept
+        until an episode is added or removed, or one of their transcripts
+        changes.
+        '''
+        key = tuple((id(episode),) + episode.transcript_key()
+                    for episode in self.episodes)
+
+        if self._speaker_counts is None or self._speaker_counts_key != key:
+            counts = collections.Counter()
+            for episode in self.episodes:
+                counts.update(episode.speaker_counts())
+
+            self._speaker_counts = counts
+            self._speaker_counts_key = key
+
+        return self._speaker_counts
+
+    def count_speaker_lines(self, character):
+        '''
+        Returns the number of lines a specific character has in the season
+
+        Inputs:
+        - character (str): Name of character (e.g., Steven)
+        '''
+        return self.speaker_counts()[character]
+
 
 class Episode():
     '''
@@ -70,7 +185,10 @@ class Episode():
             - num_season (int): The episode number in the season
             - airdate (str): Date the episode first aired
             - summary (str): Brief episode summary
-            - transcript (list): List of dictionaries
+            - transcript (TranscriptList): List of dictionaries, filled in
+                by extract_transcript; empty when the rows are streamed
+                instead. A plain list assigned to it is copied into a
+                TranscriptList.
         '''
         self.title = title
 
@@ -79,7 +197,12 @@ class Episode():
         self.num_season = None
         self.airdate = None
         self.summary = None
-        self.transcript = []
+        self.transcript = TranscriptList()
+        self._num_rows = 0 # Streamed rows, see record_row
+
+        self._speaker_index = None # See speaker_index
+        self._speaker_index_key = None
+        self._streamed_counts = collections.Counter() # See record_row
 
     def __repr__(self):
         '''
@@ -91,7 +214,89 @@ class Episode():
 
         return repr(repr_name)
 
+    @property
+    def transcript(self):
+        '''
+        Returns the TranscriptList of rows kept on the Episode
+        '''
+        return self._transcript
+
+    @transcript.setter
+    def transcript(self, rows):
+        '''
+        Replaces the transcript, copying rows into a TranscriptList unless
+        it already is one
+        '''
+        if not isinstance(rows, TranscriptList):
+            rows = TranscriptList(rows)
+        self._transcript = rows
+
     # Create methods for Episodes
+    def transcript_key(self):
+        '''
+        Returns a key that changes whenever the transcript is replaced or
+        changed in any way (see TranscriptList), or a row is streamed
+        '''
+        return (self.transcript.version, self._num_rows)
+
+    def invalidate_speaker_index(self):
+        '''
+        Throws away the speaker index, e.g., after editing rows of the
+        transcript in place (e.g., transcript[0]['speaker'] = ...), which
+        the TranscriptList cannot see
+        '''
+        self._speaker_index = None
+        self.transcript.changed()
+
+        return None
+
+    def speaker_index(self):
+        '''
+        Returns a dictionary mapping each speaker to the positions of their
+        lines in the transcript. It is built on first use, in one pass, and
+        kept until the transcript changes (see transcript_key).
+        '''
+        key = self.transcript_key()
+
+        if self._speaker_index is None or self._speaker_index_key != key:
+            index = {}
+            for position, line in enumerate(self.transcript):
+                speaker = line.get('speaker')
+                if speaker is not None:
+                    index.setdefault(speaker, []).append(position)
+
+            self._speaker_index = index
+            self._speaker_index_key = key
+
+        return self._speaker_index
+
+    def record_row(self, row):
+        '''
+        Counts a transcript row that was streamed to a sink rather than kept
+        on the transcript, so speaker counts still include it
+
+        Inputs:
+        - row (TranscriptRow or dict): A row of the episode's transcript
+        '''
+        speaker = row['speaker'] if isinstance(row, dict) else row.speaker
+
+        self._num_rows += 1
+        if speaker:
+            self._streamed_counts[speaker] += 1
+
+        return None
+
+    def speaker_counts(self):
+        '''
+        Returns a dictionary mapping each speaker to their number of lines,
+        in the transcript and in the streamed rows
+        '''
+        counts = dict(self._streamed_counts)
+        for speaker, positions in self.speaker_index().items():
+            counts[speaker] = counts.get(speaker, 0) + len(positions)
+
+        return counts
+
     def count_speaker_lines(self, character):
         '''
         Returns the number of lines a specific character has in an episode
@@ -101,54 +306,169 @@ class Episode():
 
         Returns the number of lines they speak in the episode
         '''
-        lines = 0
+        return len(self.speaker_index().get(character, [])) + \
+            self._streamed_counts[character]
+
+
+class Manifest():
+    '''
+    Class for the crawl manifest, which remembers the transcript page each
+    episode was last extracted from. See Constructor for attributes.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Creates an instance of a Manifest, loading it from disk if the file
+        exists.
+
+        Attributes:
+            - filename (str): Path of the JSON file holding the manifest
+            - entries (dict): Maps an episode title to its transcript url,
+                the SHA-256 of the page and the number of transcript rows
+            - changed (set): Titles of episodes extracted during this run
+        '''
+        self.filename = filename
+        self.entries = {}
+        self.changed = set()
+
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def is_unchanged(self, title, url, page_hash):
+        '''
+        Returns True if the episode was already extracted from the same page
+        '''
+        entry = self.entries.get(title)
+
+        return entry is not None and entry['url'] == url \
+            and entry['sha256'] == page_hash
+
+    def update(self, title, url, page_hash, rows):
+        '''
+        Records an episode that was extracted during this run
+        '''
+        self.entries[title] = {'url': url, 'sha256': page_hash, 'rows': rows}
+        self.changed.add(title)
+
+        return None
+
+    def save(self):
+        '''
+        Writes the manifest to disk
+        '''
+        with open(self.filename, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+
+        return None
+
+
+def get_parser():
+    '''
+    Returns the tree builder to parse pages with: config.html_parser, or
+        "html5lib" if lxml is asked for but not installed
+    '''
+    if config.html_parser == "lxml" and importlib.util.find_spec("lxml") is None:
+        return "html5lib"
+
+    return config.html_parser
+
+
+def convert_webpage(request, parse_only=None):
+    '''
+    Converts a request object to a BeautifulSoup object
+
+    Inputs:
+        request: a request object from util.get_request, or None
+        parse_only (SoupStrainer): the only tags to build, e.g. GUIDE_TAGS;
+            html5lib always builds the whole page
+
+    Outputs:
+        a BeautifulSoup object to parse through, if the URL request went
+            through; if not, returns None
+    '''
+    if request is not None:
+        with instrument.STATS.timer('decode'):
+            text = util.read_request(request)
+            charset = util.get_declared_charset(request)
 
-        for line in self.transcript:
-            if 'speaker' in line and line['speaker'] == character:
-                lines += 1
+        assert text is not None
+        parser = get_parser()
+        if parser == "html5lib":
+            parse_only = None
 
-        return lines
+        # Hand the parser the raw bytes, so the page is decoded exactly once
+        with instrument.STATS.timer('parse'):
+            soup = bs4.BeautifulSoup(text, parser, parse_only=parse_only,
+                                     from_encoding=charset)
+
+        return soup
 
 
-def download_convert_webpage(url):
+def download_convert_webpage(url, parse_only=None):
     '''
     Downloads a webpage using a URL and converts it to a BeautifulSoup object
 
     Inputs:
         url (str): a webpage address
+        parse_only (SoupStrainer): the only tags to build (see
+            convert_webpage)
 
     Outputs:
         a BeautifulSoup object to parse through, if the URL request goes
             through; if not, returns None
     '''
-
     request = util.get_request(url)
 
-    if request is not None:
-        text = util.read_request(request)
+    return convert_webpage(request, parse_only)
 
-        assert text is not None
-        soup = bs4.BeautifulSoup(text, "html5lib")
 
-        return soup
+def extract_transcript(url, episode, soup=None):
+    '''
+    Updates an instance of an Episode with its transcript. Downloads the
+    transcript page unless its soup has already been fetched.
+
+    Keeps every row on the Episode; use iter_transcript_rows to stream them
+    instead.
+    '''
+    if soup is None:
+        soup = download_convert_webpage(url, TRANSCRIPT_TAGS)
+
+    if soup is None:
+        logger.warning("Could not download transcript: %s", url)
+        return None
+
+    episode.transcript.extend(row._asdict()
+                              for row in iter_transcript_rows(soup, episode))
+
+    return None
 
 
-def extract_transcript(url, episode):
+def iter_transcript_rows(soup, episode):
     '''
-    Updates an instance of an Episode with its transcript
+    Walks the transcript table of a page and yields each line as soon as it
+    is parsed, without keeping any of them.
+
+    Inputs:
+        soup (BeautifulSoup): a transcript page (see TRANSCRIPT_TAGS)
+        episode (Episode): the episode the page belongs to
+
+    Yields a TranscriptRow for every line of the transcript
     '''
-    soup = download_convert_webpage(url)
+    start = time.perf_counter()
+    seconds = 0
+    num_rows = 0
 
     find_title = soup.find('h1', id="firstHeading")
     #print(find_title)
 
     if not find_title:
-        print("Could not find title. This shouldn't happen.")
+        logger.warning("Could not find title. This shouldn't happen.")
 
     else:
         title = find_title.text[:-11]
-        print("Current episode title is:", episode.title)
-        print("Title of this webpage is:", title)
+        logger.debug("Current episode title is: %s", episode.title)
+        logger.debug("Title of this webpage is: %s", title)
 
         if len(title) > len(episode.title):
             assert title[:len(episode.title)] == episode.title
@@ -161,64 +481,71 @@ def extract_transcript(url, episode):
     rows = table.find_all('tr')
     #print("Number of rows:", len(rows))
 
-    for row in rows[1:]:
-        # Skip the first row; it will always be Speaker and Dialogue
-        speaker = row.find('th')
-        data = row.find('td')
+    try:
+        for row in rows[1:]:
+            # Skip the first row; it will always be Speaker and Dialogue
+            speaker = row.find('th')
+            data = row.find('td')
 
-        if not data:
-            #print("Could not find data")
-            continue
+            if not data:
+                #print("Could not find data")
+                continue
 
-        data = data.text.strip() # To remove the '\n'
+            data = data.text.strip() # To remove the '\n'
 
-        content = {"episode": episode.title, # Connect transcript to episode
-                   "speaker": None,
-                   "actions": [],
-                   "quote": None,
-                   "location": None,
-                   "description": None}
+            content = {"episode": episode.title, # Connect transcript to episode
+                       "speaker": None,
+                       "actions": [],
+                       "quote": None,
+                       "location": None,
+                       "description": None}
 
-        if speaker:
-            content['speaker'] = speaker.text.strip() # To remove the '\n'
+            if speaker:
+                content['speaker'] = speaker.text.strip() # To remove the '\n'
 
-            if '*' in data:
-                content['actions'] = []
-                num_actions = data.count('*') / 2
-                pattern = r'(?<=\*).+?(?=\*)'
-                matches = re.findall(pattern, data)
+                if '*' in data:
+                    content['actions'] = []
+                    num_actions = data.count('*') / 2
+                    pattern = r'(?<=\*).+?(?=\*)'
+                    matches = re.findall(pattern, data)
 
-                for index, match in enumerate(matches):
-                    if index % 2 == 0:
-                        content['actions'].append(match)
+                    for index, match in enumerate(matches):
+                        if index % 2 == 0:
+                            content['actions'].append(match)
 
-                for action in content['actions']:
-                    data = data.replace(action, '')
-                clean_quote = " ".join(data.split()).replace('**', '').strip()
+                    for action in content['actions']:
+                        data = data.replace(action, '')
+                    clean_quote = " ".join(data.split()).replace('**', '').strip()
 
-                content['quote'] = clean_quote
+                    content['quote'] = clean_quote
 
-            else:
-                content['quote'] = data
+                else:
+                    content['quote'] = data
 
-        elif '[' in data:
-            #print(data)
-            pattern = r'(?<=\[).+?(?=\])'
-            results = re.search(pattern, data)
-            if results:
-                content['location'] = results.group(0)
+            elif '[' in data:
+                #print(data)
+                pattern = r'(?<=\[).+?(?=\])'
+                results = re.search(pattern, data)
+                if results:
+                    content['location'] = results.group(0)
 
-        elif '(' in data:
-            #print(data)
-            pattern = r'(?<=\().+?(?=\))'
-            results = re.search(pattern, data)
-            if results:
-                content['description'] = results.group(0)
+            elif '(' in data:
+                #print(data)
+                pattern = r'(?<=\().+?(?=\))'
+                results = re.search(pattern, data)
+                if results:
+                    content['description'] = results.group(0)
 
-        episode.transcript.append(content)
-        #print("Appended content to the episode")
+            # Time spent by whoever consumes the row is not extraction
+            seconds += time.perf_counter() - start
+            num_rows += 1
+            yield TranscriptRow(**content)
+            start = time.perf_counter()
 
-    return None
+    finally:
+        seconds += time.perf_counter() - start
+        instrument.STATS.add_time('extract', seconds)
+        instrument.STATS.record_episode(episode.title, num_rows)
 
 
 def convert_string_to_datetime(date_string, format='%B %d, %Y'):
@@ -248,7 +575,7 @@ def get_season_data(soup):
 
         season_name = data[1].find('b').contents[0].strip('"')
         season = Season(season_name)
-        print('Created an instance of a Season:', season.name)
+        logger.debug('Created an instance of a Season: %s', season.name)
 
         if season.name == 'Movie':
             season.num_episodes = 1
@@ -272,19 +599,26 @@ def get_season_data(soup):
     return list_of_seasons
 
 
-def get_episode_data(soup, all_seasons):
+def list_episodes(soup, all_seasons):
     '''
+    Creates an Episode for every episode in the Episode Guide, without
+    downloading any transcripts.
+
+    Returns a list of (season, episode, transcript url) tuples, in the order
+        the episodes appear in the guide
     '''
+    episodes_to_visit = []
+
     num_table=2
     all_wikitables = soup.find_all('table', class_='wikitable')
     movie_table = soup.find_all('table', class_='bgrevo')[1]
 
     for num_season in range(len(all_seasons)):
         current_season = all_seasons[num_season]
-        print("Working on season:", current_season.name)
+        logger.info("Working on season: %s", current_season.name)
 
         for num_episode in range(current_season.num_episodes):
-            print("Working on episode:", num_episode+1)
+            logger.debug("Working on episode: %d", num_episode+1)
 
             # Season 1 starts with table at index 2
             current_ep_table = all_wikitables[num_table]
@@ -317,24 +651,146 @@ def get_episode_data(soup, all_seasons):
                     current_ep = Episode(ep_title)
 
                     current_ep.summary = data[4].text.strip()
-                    print(current_ep.summary)
+                    logger.debug(current_ep.summary)
 
                     ep_url = data[1].find('a').get('href')
 
                 ep_url_to_visit = LIMITING_DOMAIN + ep_url + '/Transcript'
-                print(ep_url_to_visit)
+                logger.debug(ep_url_to_visit)
 
-                extract_transcript(ep_url_to_visit, current_ep)
-                print("Got transcript for " + current_ep.title)
-
-                current_ep.season = current_season.name # Connect episode to season
-                current_season.episodes.append(current_ep)
+                episodes_to_visit.append((current_season, current_ep,
+                                          ep_url_to_visit))
 
             else:
                 continue
 
+    return episodes_to_visit
+
+
+def iter_episode_rows(soup, all_seasons, max_workers=None,
+                      requests_per_second=None, manifest=None, record=True):
+    '''
+    Yields every episode, with a generator of its transcript rows, in
+    episode order. Transcript pages are downloaded concurrently, a few
+    pages ahead of the episode being yielded (see util.iter_requests), and
+    each page is parsed only as its rows are consumed. Nothing is kept on
+    the Episode except its metadata and speaker counts (see
+    Episode.record_row), so memory does not grow with the number of
+    episodes crawled.
+
+    With a manifest, only episodes that are new or whose transcript page
+    changed since the last run are extracted; the manifest is updated once
+    an episode's rows have all been consumed.
+
+    Inputs:
+        - soup (BeautifulSoup): the Episode Guide page
+        - all_seasons (list): Seasons from get_season_data
+        - max_workers (int): most pages to download at once (see config)
+        - requests_per_second (float): most requests per second to the wiki
+            (see config)
+        - manifest (Manifest): the manifest of a previous crawl, or None to
+            extract every episode
+        - record (bool): Count each row on its Episode as it is consumed;
+            turn it off if the rows are kept on the transcript instead, so
+            they are not counted twice
+
+    Yields (season, episode, rows) tuples, where rows is a generator of
+        TranscriptRows, or None if the transcript was unchanged or could not
+        be downloaded. Consume rows before moving on to the next episode.
+    '''
+    if max_workers is None:
+        max_workers = config.max_workers
+    if requests_per_second is None:
+        requests_per_second = config.requests_per_second
+
+    episodes_to_visit = list_episodes(soup, all_seasons)
+    urls = [url for _, _, url in episodes_to_visit]
+
+    logger.info("Downloading %d transcripts...", len(urls))
+    page_requests = util.iter_requests(urls, max_workers, requests_per_second)
+
+    for (current_season, current_ep, url), request in zip(episodes_to_visit,
+                                                          page_requests):
+        rows = None
+        current_ep.season = current_season.name # Connect episode to season
+
+        if request is None:
+            logger.warning("Could not download transcript: %s", url)
+
+        elif manifest is None:
+            rows = stream_rows(request, current_ep, record=record)
+            logger.info("Got transcript for %s", current_ep.title)
+
+        else:
+            page_hash = hashlib.sha256(request.content).hexdigest()
+
+            if manifest.is_unchanged(current_ep.title, url, page_hash):
+                logger.info("Transcript unchanged for %s", current_ep.title)
+            else:
+                rows = stream_rows(request, current_ep, manifest, url,
+                                   page_hash, record)
+                logger.info("Got transcript for %s", current_ep.title)
+
+        # The rows generator holds the response until it is consumed
+        request = None
+
+        yield current_season, current_ep, rows
+
+
+def stream_rows(request, episode, manifest=None, url=None, page_hash=None,
+                record=True):
+    '''
+    Parses a transcript page once its first row is asked for, and yields its
+    rows (see iter_transcript_rows), counting each one on the episode unless
+    record is False, then records the page in the manifest, if any
+    '''
+    soup = convert_webpage(request, TRANSCRIPT_TAGS)
+    request = None # Parsed, so let go of the response
+
+    num_rows = 0
+    for row in iter_transcript_rows(soup, episode):
+        if record:
+            episode.record_row(row)
+        num_rows += 1
+        yield row
+
+    if manifest is not None:
+        manifest.update(episode.title, url, page_hash, num_rows)
+
+
+def iter_episode_data(soup, all_seasons, max_workers=None,
+                      requests_per_second=None, manifest=None):
+    '''
+    Yields every episode, with its transcript kept on the Episode, in episode
+    order. Takes the same inputs as iter_episode_rows.
+
+    Yields (season, episode, extracted) tuples, where extracted is False if
+        the transcript was unchanged or could not be downloaded
+    '''
+    for current_season, current_ep, rows in iter_episode_rows(
+            soup, all_seasons, max_workers, requests_per_second, manifest,
+            record=False):
+        if rows is not None:
+            current_ep.transcript.extend(row._asdict() for row in rows)
+
+        yield current_season, current_ep, rows is not None
+
+
+def get_episode_data(soup, all_seasons, max_workers=None,
+                     requests_per_second=None, manifest=None):
+    '''
+    Adds every episode, with its transcript, to its Season. Takes the same
+    inputs as iter_episode_data.
+
+    Returns the list of Seasons
+    '''
+    for current_season, current_ep, _ in iter_episode_data(
+            soup, all_seasons, max_workers, requests_per_second, manifest):
+        current_season.episodes.append(current_ep)
+
     return all_seasons
 
+
 def ensure_dict(object):
     '''
     Make sure the object is of dictionary type
@@ -342,6 +798,8 @@ def ensure_dict(object):
 
     if isinstance(object, dict):
         return object
+    elif isinstance(object, tuple) and hasattr(object, '_asdict'):
+        return object._asdict() # e.g., a TranscriptRow
     else:
         return object.__dict__
 
@@ -349,79 +807,432 @@ def write_rows(csvfile, list_of_dict, final_cols, header=False):
     '''
     Writes each dictionary into a CSV's row
     '''
-    writer = csv.DictWriter(csvfile, fieldnames=final_cols)
+    writer = csv.DictWriter(csvfile, fieldnames=final_cols,
+                            extrasaction='ignore')
 
     if header:
         writer.writeheader()
 
-    for d in list_of_dict:
-        to_parse = ensure_dict(d)
-        filtered_d = dict(
-            (k, v) for k, v in to_parse.items() if k in final_cols
-        )
-        writer.writerow(filtered_d)
+    writer.writerows(ensure_dict(d) for d in list_of_dict)
 
     return None
 
 
+class CSVWriter():
+    '''
+    Class for a CSV that stays open while rows are streamed into it. Rows
+    are written in batches to a temporary file, which replaces file_name
+    once the writer is closed. See Constructor for attributes.
+
+    Example:
+        with CSVWriter('transcripts.csv', TRANSCRIPT_COLUMNS) as writer:
+            writer.writerows(episode.transcript)
+    '''
+
+    def __init__(self, file_name, columns, batch_size=1000):
+        '''
+        Creates an instance of a CSVWriter and writes the header.
+
+        Attributes:
+            - file_name (str): Path of the finished CSV
+            - columns (list): Column names; other keys in a row are ignored
+            - batch_size (int): Number of rows held before they are written
+            - rows_written (int): Number of rows written so far
+        '''
+        self.file_name = file_name
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows_written = 0
+
+        self.tmp_name = file_name + '.tmp'
+        self.csvfile = open(self.tmp_name, 'w', newline='')
+        self.writer = csv.DictWriter(self.csvfile, fieldnames=columns,
+                                     extrasaction='ignore')
+        self.writer.writeheader()
+        self.batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(keep=exc_type is None)
+
+    def writerow(self, row):
+        '''
+        Adds a dictionary (or an object, see ensure_dict) as a row
+        '''
+        self.batch.append(ensure_dict(row))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+        return None
+
+    def writerows(self, rows):
+        '''
+        Adds every row from an iterable, e.g. a list or a generator
+        '''
+        for row in rows:
+            self.writerow(row)
+
+        return None
+
+    def flush(self):
+        '''
+        Writes the rows held in the batch
+        '''
+        self.writer.writerows(self.batch)
+        self.rows_written += len(self.batch)
+        self.batch = []
+
+        return None
+
+    def close(self, keep=True):
+        '''
+        Writes the last batch and moves the CSV into place, or throws it
+        away if keep is False (so the previous file survives a failed run)
+        '''
+        if keep:
+            self.flush()
+        self.csvfile.close()
+
+        if keep:
+            os.replace(self.tmp_name, self.file_name)
+        else:
+            os.remove(self.tmp_name)
+
+        return None
+
+
+class SQLiteWriter():
+    '''
+    Class for a table in a SQLite database that rows are streamed into, with
+    the same methods as CSVWriter. The table is replaced, and every writer on
+    a connection shares its transaction, so nothing is visible until the
+    owner of the connection commits. See Constructor for attributes.
+
+    Example:
+        conn.execute('BEGIN;')
+        with SQLiteWriter(conn, 'transcripts', TRANSCRIPT_COLUMNS) as writer:
+            writer.writerows(iter_transcript_rows(soup, episode))
+        conn.execute('COMMIT;')
+    '''
+
+    def __init__(self, conn, table, columns, batch_size=1000):
+        '''
+        Creates an instance of a SQLiteWriter and creates its table.
+
+        Attributes:
+            - conn (Connection): Connection to the database
+            - table (str): Name of the table
+            - columns (list): Column names; other keys in a row are ignored
+            - batch_size (int): Number of rows held before they are written
+            - rows_written (int): Number of rows written so far
+        '''
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows_written = 0
+
+        conn.execute('DROP TABLE IF EXISTS {};'.format(table))
+        conn.execute('CREATE TABLE {} ({});'.format(
+            table, ', '.join(column + ' TEXT' for column in columns)))
+
+        self.sql = 'INSERT INTO {} VALUES ({});'.format(
+            table, ', '.join('?' * len(columns)))
+        self.batch = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(keep=exc_type is None)
+
+    def writerow(self, row):
+        '''
+        Adds a dictionary (or an object, see ensure_dict) as a row. Values
+        are stored as the CSV would write them e.g., actions as "['...']"
+        '''
+        row = ensure_dict(row)
+        self.batch.append(tuple(to_sql_value(row.get(column))
+                                for column in self.columns))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+        return None
+
+    def writerows(self, rows):
+        '''
+        Adds every row from an iterable, e.g. a list or a generator
+        '''
+        for row in rows:
+            self.writerow(row)
+
+        return None
+
+    def flush(self):
+        '''
+        Inserts the rows held in the batch
+        '''
+        self.conn.executemany(self.sql, self.batch)
+        self.rows_written += len(self.batch)
+        self.batch = []
+
+        return None
+
+    def close(self, keep=True):
+        '''
+        Inserts the last batch, or throws it away if keep is False; the
+        owner of the connection commits or rolls back
+        '''
+        if keep:
+            self.flush()
+        self.batch = []
+
+        return None
+
+
+def to_sql_value(value):
+    '''
+    Returns a value SQLite can store: None, numbers and strings as they are,
+    anything else (e.g., lists and dates) as its string, like csv does
+    '''
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+
+    return str(value)
+
+
+def read_sqlite_rows(db_file, table='transcripts'):
+    '''
+    Reads the transcripts table written by a SQLiteWriter and returns a
+        dictionary mapping each episode title to its list of rows
+        (dictionaries), like read_transcript_rows
+    '''
+    rows_by_episode = {}
+
+    if os.path.isfile(db_file):
+        conn = sqlite3.connect(db_file)
+        conn.row_factory = sqlite3.Row
+        try:
+            for row in conn.execute('SELECT * FROM {};'.format(table)):
+                rows_by_episode.setdefault(row['episode'], []).append(
+                    dict(row))
+        except sqlite3.OperationalError:
+            pass # No table yet
+        finally:
+            conn.close()
+
+    return rows_by_episode
+
+
+def read_transcript_rows(file_name):
+    '''
+    Reads an existing transcripts CSV and returns a dictionary mapping each
+        episode title to its list of rows (dictionaries)
+    '''
+    rows_by_episode = {}
+
+    if os.path.isfile(file_name):
+        with open(file_name, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                rows_by_episode.setdefault(row['episode'], []).append(row)
+
+    return rows_by_episode
+
+
 def convert_to_csv(list_of_dict, file_name):
     '''
-    Takes a list of pseudo-dictionaries and returns a CSV with a given filename
+    Takes a list of pseudo-dictionaries and writes them to a CSV with a given
+        filename, with a header. An existing file is replaced, not appended
+        to, so running it twice does not duplicate the rows.
     '''
     skip_cols = ['episodes', 'transcript']
     def_a_dict = ensure_dict(list_of_dict[0])
 
     # Assumes that every pseudo-dictionary has the same keys
-    final_cols = [col for col in def_a_dict.keys() if col not in skip_cols]
-
-    if not os.path.isfile(file_name):
-        with open(file_name, 'w') as csvfile:
-            write_rows(csvfile, list_of_dict, final_cols, header=True)
+    final_cols = [col for col in def_a_dict.keys()
+                  if col not in skip_cols and not col.startswith('_')]
 
-    else:
-        with open(file_name, 'a') as csvfile:
-            write_rows(csvfile, list_of_dict, final_cols)
+    with CSVWriter(file_name, final_cols) as writer:
+        writer.writerows(list_of_dict)
 
     return None
 
 
+@contextlib.contextmanager
+def open_sink(sink):
+    '''
+    Opens the place the crawl is written to: a CSV per table in
+    config.data_folder ('csv'), or a table per CSV in config.scrape_database
+    ('sqlite'), written in a single transaction that is only committed if
+    the crawl finishes
+
+    Yields a function that takes a table name (e.g., 'transcripts') and its
+        columns, and returns a CSVWriter or SQLiteWriter for it
+    '''
+    if sink == 'csv':
+        yield lambda table, columns: CSVWriter(
+            config.data_folder + table + '.csv', columns)
+        return
+
+    if sink != 'sqlite':
+        raise ValueError("sink must be 'csv' or 'sqlite'")
+
+    conn = sqlite3.connect(config.scrape_database)
+    conn.isolation_level = None # Manage the transaction by hand
+    conn.execute('BEGIN;')
+
+    try:
+        yield lambda table, columns: SQLiteWriter(conn, table, columns)
+        conn.execute('COMMIT;')
+    except BaseException:
+        conn.execute('ROLLBACK;')
+        raise
+    finally:
+        conn.close()
+
+
+def write_timed(writer, rows):
+    '''
+    Writes every row from an iterable, timing only the writes as one run of
+    the write stage (producing the rows may be timed as another stage)
+
+    Returns the number of rows written
+    '''
+    seconds = 0
+    num_rows = 0
+
+    for row in rows:
+        start = time.perf_counter()
+        writer.writerow(row)
+        seconds += time.perf_counter() - start
+        num_rows += 1
+
+    instrument.STATS.add_time('write', seconds)
+
+    return num_rows
+
+
 # Crawl through wiki pages
-def main():
+def crawl(offline=config.offline, incremental=False, sink=config.sink):
     '''
     Scrape wiki data, starting with the first episode of the first season,
     and creates Episode objects. Each Episode is then appended to the Season's
-    list of episodes.
+    list of episodes, keeping only its metadata and speaker counts; its rows
+    are streamed straight to the sink as they are parsed.
+
+    Inputs:
+        - offline (bool): Read pages only from the response cache (see
+            config.cache_folder), without touching the network; raises a
+            ValueError if there is no cache folder
+        - incremental (bool): Only extract episodes that are new or whose
+            transcript page changed since the last run (see the manifest in
+            config.data_folder); rows for the other episodes are kept
+        - sink (str): 'csv' or 'sqlite' (see open_sink)
     '''
     starting_url = "https://steven-universe.fandom.com/wiki/Episode_Guide"
-    season_csv = config.data_folder + 'seasons.csv'
-    episode_csv = config.data_folder + 'episodes.csv'
-    transcripts_csv = config.data_folder + 'transcripts.csv'
+    manifest_file = config.data_folder + 'manifest.json'
 
-    soup = download_convert_webpage(starting_url)
+    util.configure_session(timeout=config.request_timeout,
+                           retries=config.max_retries,
+                           pool_size=config.max_workers)
+    util.configure_cache(config.cache_folder, offline=offline)
+
+    soup = download_convert_webpage(starting_url, GUIDE_TAGS)
 
     all_seasons = get_season_data(soup)
-    print(all_seasons)
+    logger.debug(all_seasons)
+
+    # Keep the rows of episodes that are not extracted again
+    old_transcripts = {}
+    if incremental and sink == 'sqlite':
+        old_transcripts = read_sqlite_rows(config.scrape_database)
+    elif incremental:
+        old_transcripts = read_transcript_rows(
+            config.data_folder + 'transcripts.csv')
+
+    manifest = Manifest(manifest_file) if incremental else None
+    if manifest is not None and not old_transcripts:
+        manifest.entries = {} # No rows to keep, so extract everything
+
+    with open_sink(sink) as open_writer:
+        # Create the seasons table
+        logger.info("Writing seasons to %s...", sink)
+        with open_writer('seasons', SEASON_COLUMNS) as season_writer:
+            write_timed(season_writer, all_seasons)
+
+        # Build out the episodes and transcripts as each episode is parsed
+        with open_writer('episodes', EPISODE_COLUMNS) as episode_writer, \
+                open_writer('transcripts',
+                            TRANSCRIPT_COLUMNS) as transcript_writer:
+
+            for season, episode, rows in iter_episode_rows(
+                    soup, all_seasons, manifest=manifest):
+                write_timed(episode_writer, [episode])
+
+                if rows is None:
+                    # Unchanged, or the download failed (see the request
+                    # summary)
+                    rows = old_transcripts.pop(episode.title, [])
+                    for row in rows:
+                        episode.record_row(row)
+
+                write_timed(transcript_writer, rows)
+                season.episodes.append(episode)
+
+    logger.info("Wrote %d transcript rows", transcript_writer.rows_written)
+
+    if manifest is not None:
+        logger.info("%d episodes were new or changed", len(manifest.changed))
+        manifest.save()
+
+    return all_seasons
+
 
-    seasons_with_episodes = get_episode_data(soup, all_seasons)
-    print("Got episodes!")
+def main(offline=config.offline, incremental=False, sink=config.sink,
+         profile=config.profile, trace_memory=config.trace_memory):
+    '''
+    Crawls the wiki (see crawl), then logs how long each stage took, the
+    requests that were sent and, if asked for, a profile of the whole run.
+
+    Inputs:
+        - offline (bool): see crawl
+        - incremental (bool): see crawl
+        - sink (str): see crawl
+        - profile (bool): Profile the crawl with cProfile
+        - trace_memory (bool): Trace the crawl's memory with tracemalloc
+    '''
+    instrument.STATS.reset()
+    start = time.perf_counter()
 
-    # Create seasons.csv
-    print("Creating seasons.csv...")
-    convert_to_csv(seasons_with_episodes, season_csv)
+    with instrument.Profiler(cpu=profile, memory=trace_memory) as profiler:
+        crawl(offline, incremental, sink)
 
-    for season in seasons_with_episodes:
-        print("Adding episodes from", season.name, "to episodes.csv")
-        # Build out episodes.csv
-        convert_to_csv(season.episodes, episode_csv)
+    logger.info("Crawled in %.1fs\n%s", time.perf_counter() - start,
+                instrument.STATS.report())
+    logger.info(util.REQUEST_LOG.summary())
 
-        # Build out transcripts.csv
-        for episode in season.episodes:
-            print("Adding transcript from", episode.title, "to transcripts.csv")
-            convert_to_csv(episode.transcript, transcripts_csv)
+    if profile or trace_memory:
+        logger.info("Profile of the crawl:\n%s", profiler.report())
 
     return None
 
 
 if __name__ == "__main__":
-    usage = "python3 scrape_wiki.py"
-    main()
+    usage = ("python3 scrape_wiki.py [--offline] [--incremental] [--sqlite] "
+             "[--verbose] [--profile] [--trace-memory]")
+    args = sys.argv[1:]
+
+    if any(arg not in ['--offline', '--incremental', '--sqlite', '--verbose',
+                       '--profile', '--trace-memory'] for arg in args):
+        print(usage)
+        sys.exit(0)
+
+    instrument.configure_logging('DEBUG' if '--verbose' in args
+                                 else config.log_level)
+    main(offline='--offline' in args or config.offline,
+         incremental='--incremental' in args,
+         sink='sqlite' if '--sqlite' in args else config.sink,
+         profile='--profile' in args or config.profile,
+         trace_memory='--trace-memory' in args or config.trace_memory)
@@ -4,13 +4,285 @@ Utility code
 
 import urllib.parse
 import os
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
 import bs4
 
+import instrument
+
+TIMEOUT = 30 # Seconds to wait for the server to connect and to respond
+RETRIES = 3
+BACKOFF_FACTOR = 0.5 # Retries wait 0.5s, 1s, 2s, ...
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 10 # Connections kept alive per host
+CHARSET_PATTERN = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+CACHE = None # See configure_cache
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLog():
+    '''
+    Records how long each request took and which URLs could not be fetched.
+    Can be shared between threads.
+    '''
+
+    def __init__(self):
+        '''
+        Creates an instance of a RequestLog.
+
+        Attributes:
+            - latencies (dict): Maps a URL to the seconds its request took
+            - failed (dict): Maps a URL to the reason its request failed
+        '''
+        self.latencies = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def record(self, url, seconds, error=None):
+        '''
+        Records a finished request, and the reason it failed, if it did
+        '''
+        with self.lock:
+            self.latencies[url] = seconds
+            if error is not None:
+                self.failed[url] = error
+
+    def summary(self):
+        '''
+        Returns a string with the number of requests, their mean and slowest
+            latencies, and the URLs that failed
+        '''
+        with self.lock:
+            latencies = list(self.latencies.values())
+            failed = dict(self.failed)
+
+        if not latencies:
+            return "No requests sent"
+
+        lines = ["{} requests, mean {:.3f}s, slowest {:.3f}s, {} failed".format(
+            len(latencies), sum(latencies) / len(latencies), max(latencies),
+            len(failed))]
+        for url, error in failed.items():
+            lines.append("    Failed: {} ({})".format(url, error))
+
+        return "\n".join(lines)
+
+
+REQUEST_LOG = RequestLog()
+
+
+class ResponseCache():
+    '''
+    On-disk cache of response bodies, keyed by URL. Bodies are stored once
+    under the SHA-256 of their content (objects/), and each URL points to
+    its body along with the headers needed to revalidate it (urls/).
+    '''
+
+    def __init__(self, folder, offline=False):
+        '''
+        Creates an instance of a ResponseCache.
+
+        Attributes:
+            - folder (str): Directory holding the cache
+            - offline (bool): Serve only from the cache, without touching
+                the network
+        '''
+        self.folder = folder
+        self.offline = offline
+
+        os.makedirs(os.path.join(folder, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(folder, 'urls'), exist_ok=True)
+
+    def url_path(self, url):
+        '''
+        Returns the path of the entry for a URL
+        '''
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, 'urls', key + '.json')
+
+    def object_path(self, digest):
+        '''
+        Returns the path of the body with a given SHA-256 digest
+        '''
+        return os.path.join(self.folder, 'objects', digest)
+
+    def load(self, url):
+        '''
+        Returns the entry (dict) for a URL, or None if it is not cached
+        '''
+        try:
+            with open(self.url_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.isfile(self.object_path(entry['sha256'])):
+            return None
+
+        return entry
+
+    def store(self, url, request):
+        '''
+        Saves the body and revalidation headers of a successful request.
+
+        Returns the new entry (dict)
+        '''
+        body = request.content
+        digest = hashlib.sha256(body).hexdigest()
+
+        object_path = self.object_path(digest)
+        if not os.path.isfile(object_path):
+            write_atomic(object_path, body)
+
+        entry = {'url': url,
+                 'sha256': digest,
+                 'headers': {header: request.headers[header]
+                             for header in CACHED_HEADERS
+                             if header in request.headers}}
+        write_atomic(self.url_path(url), json.dumps(entry).encode('utf-8'))
+
+        return entry
+
+    def revalidation_headers(self, entry):
+        '''
+        Returns the conditional request headers for a cached entry
+        '''
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        return headers
+
+    def to_request(self, entry):
+        '''
+        Returns a request object built from a cached entry, so it can be
+        read like one that came from the network
+        '''
+        with open(self.object_path(entry['sha256']), 'rb') as f:
+            body = f.read()
+
+        r = requests.Response()
+        r._content = body
+        r.status_code = 200
+        r.url = entry['url']
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.from_cache = True
+
+        return r
+
+
+def write_atomic(path, data):
+    '''
+    Writes bytes to a file so that readers never see a partial file
+    '''
+    tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def configure_cache(folder, offline=False):
+    '''
+    Turns on the response cache for every request made by get_request, or
+    turns it off if folder is None. Offline mode needs a cache to read from,
+    so asking for it without a folder raises a ValueError rather than
+    quietly going to the network.
+    '''
+    global CACHE
+
+    if offline and folder is None:
+        raise ValueError('Offline mode reads pages from the response cache; '
+                         'set config.cache_folder to use it')
+
+    CACHE = ResponseCache(folder, offline) if folder is not None else None
+
+    return None
+
+
+def create_session(retries=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                   pool_size=POOL_SIZE):
+    '''
+    Creates a requests Session that keeps connections alive and retries
+    failed requests with exponential backoff.
+
+    Inputs:
+        retries (int): most times to retry a request
+        backoff_factor (float): base for the wait between retries
+        pool_size (int): connections kept alive per host; should be at least
+            the number of threads sharing the session
+
+    Outputs:
+        a requests Session
+    '''
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(['GET', 'HEAD']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_session():
+    '''
+    Returns the Session shared by every request, creating it if needed
+    '''
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = create_session()
+
+    return SESSION
+
+
+def configure_session(timeout=None, **kwargs):
+    '''
+    Replaces the shared Session. Takes the same keyword arguments as
+    create_session, plus the timeout (seconds) to use for every request.
+    '''
+    global SESSION, TIMEOUT
+
+    if timeout is not None:
+        TIMEOUT = timeout
+
+    with SESSION_LOCK:
+        SESSION = create_session(**kwargs)
+
+    return None
+
+
 def get_request(url):
     '''
     Open a connection to the specified URL and if successful
-    read the data.
+    read the data. Uses the shared Session, so connections are reused and
+    requests that fail with 429 or a 5xx are retried with backoff. If the
+    response cache is on (see configure_cache), cached pages are revalidated
+    with If-None-Match / If-Modified-Since, or served as-is when offline.
 
     Inputs:
         url: must be an absolute URL
@@ -22,36 +294,174 @@ def get_request(url):
         get_request("http://www.cs.uchicago.edu")
     '''
 
-    if is_absolute_url(url):
-        try:
-            r = requests.get(url)
-            if r.status_code == 404 or r.status_code == 403:
-                r = None
-        except Exception:
-            # fail on any kind of error
+    if not is_absolute_url(url):
+        return None
+
+    start = time.perf_counter()
+    error = None
+    entry = CACHE.load(url) if CACHE is not None else None
+
+    if CACHE is not None and CACHE.offline:
+        if entry is not None:
+            r = CACHE.to_request(entry)
+            instrument.STATS.count('pages_from_cache')
+        else:
+            error = "Not cached"
             r = None
-    else:
+
+        record_fetch(url, time.perf_counter() - start, error)
+        return r
+
+    headers = CACHE.revalidation_headers(entry) if entry is not None else {}
+
+    try:
+        r = get_session().get(url, headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304 and entry is not None:
+            # Not modified since it was cached
+            r = CACHE.to_request(entry)
+            instrument.STATS.count('pages_not_modified')
+        elif not r.ok:
+            error = "HTTP {}".format(r.status_code)
+            r = None
+        else:
+            instrument.STATS.count('pages_downloaded')
+            instrument.STATS.count('bytes_downloaded', len(r.content))
+            if CACHE is not None:
+                CACHE.store(url, r)
+                r.from_cache = False
+    except Exception as e:
+        # fail on any kind of error
+        error = type(e).__name__
         r = None
 
-    print("Successfully got request")
+    record_fetch(url, time.perf_counter() - start, error)
+
     return r
 
 
+def record_fetch(url, seconds, error=None):
+    '''
+    Records a finished request in REQUEST_LOG and as a run of the fetch
+    stage, and logs whether it went through
+    '''
+    REQUEST_LOG.record(url, seconds, error)
+    instrument.STATS.add_time('fetch', seconds)
+
+    if error is None:
+        logger.debug("Got %s in %.3fs", url, seconds)
+    else:
+        instrument.STATS.count('pages_failed')
+        logger.warning("Could not get %s (%s)", url, error)
+
+
+class HostRateLimiter():
+    '''
+    Caps the number of requests sent to any one host per second. Can be
+    shared between threads.
+    '''
+
+    def __init__(self, per_second=None):
+        '''
+        Creates an instance of a HostRateLimiter.
+
+        Attributes:
+            - interval (float): Seconds to wait between requests to a host,
+                or zero if there is no cap
+            - next_slot (dict): Maps a host to the earliest time the next
+                request to it may be sent
+        '''
+        self.interval = 1.0 / per_second if per_second else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        '''
+        Blocks until a request to the host of url may be sent
+        '''
+        if not self.interval:
+            return None
+
+        host = urllib.parse.urlparse(url).netloc
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+        return None
+
+
+def iter_requests(urls, max_workers=8, per_second=None, window=None):
+    '''
+    Open connections to several URLs at the same time, using a bounded pool
+    of worker threads, and yield the responses in order as they are needed.
+    At most window requests are sent ahead of the one being yielded, so
+    only that many responses are held in memory at once.
+
+    Inputs:
+        urls: iterable of absolute URLs
+        max_workers (int): most requests in flight at once
+        per_second (float): most requests per second sent to any one host,
+            or None for no cap
+        window (int): most responses fetched ahead of the caller, by default
+            twice max_workers
+
+    Outputs:
+        generator of request objects (or None, see get_request), in the same
+        order as urls
+    '''
+    limiter = HostRateLimiter(per_second)
+    window = window or 2 * max_workers
+
+    def fetch(url):
+        if CACHE is None or not CACHE.offline:
+            limiter.wait(url)
+        return get_request(url)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+
+        for url in urls:
+            pending.append(executor.submit(fetch, url))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
 def read_request(request):
     '''
-    Return data from request object.  Returns result or "" if the read
-    fails..
+    Return the raw bytes from request object, without decoding them; see
+    get_declared_charset for how to decode them. Returns result or b"" if
+    the read fails.
     '''
     try:
-        print('Encoding is:', request.encoding)
-        if request.encoding != 'ISO-8859-1':
-            request.encoding = 'ISO-8859-1'
-            #print('    Changed encoding to:', request.encoding)
-        return request.text.encode('ISO-8859-1')
+        return request.content
 
     except Exception:
-        print("Read failed: " + request.url)
-        return ""
+        logger.warning("Read failed: %s", request.url)
+        return b""
+
+
+def get_declared_charset(request):
+    '''
+    Return the charset declared in the Content-Type header of the request,
+    or None if the server did not declare one (the parser then looks for a
+    <meta charset> in the page itself).
+
+    Unlike request.encoding, this does not fall back to ISO-8859-1 for text
+    responses without a charset.
+    '''
+    match = CHARSET_PATTERN.search(request.headers.get('Content-Type', ''))
+
+    if match:
+        return match.group(1)
+
+    return None
 
 
 def get_request_url(request):
@@ -66,10 +476,8 @@ def is_absolute_url(url):
     Is url an absolute URL?
     '''
     if url == "":
-        print("This is an empty URL")
         return False
 
-    print("This is an absolute URL: ", urllib.parse.urlparse(url).netloc != "")
     return urllib.parse.urlparse(url).netloc != ""
 
 